@@ -21,7 +21,7 @@
     Date: 5 May 2021
 '''
 
-import serial
+from grbl_streamer import GrblStreamer
 import sys
 import os
 
@@ -45,13 +45,8 @@ if __name__ == "__main__":
     for key in thm.id_fields:
         print('{}: {}'.format(key, device_id[key]))
     
-# Open grbl serial port
-s = serial.Serial('COM8',115200)
-    
-# Wake up grbl
-s.write(b"\r\n\r\n")
-time.sleep(2)   # Wait for grbl to initialize
-s.flushInput()  # Flush startup text in serial input
+# Open and wake up grbl. Lines are streamed: consecutive moves blend in the planner
+grbl = GrblStreamer('COM8')
     
 w = 1
 
@@ -76,13 +71,11 @@ Bfield_3D_array=np.array([])
 # Move to front, bottom-left corner of map. Code finishes at back, top-right.
 half_stepsX = int((n_sizeX-1)/2)
 for z_half in range(0, half_stepsX):
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
+    grbl.send(z_backwords)
+    grbl.send(z_backwords)
+    grbl.send(z_backwords)
     
+grbl.flush()
 time.sleep(10)
 thm.make_measurement(**params)
 meas=thm.last_reading
@@ -99,12 +92,10 @@ for k in range(0, n_sizeX-1):
             w=w+1
             #print("x is %s" % (x))
             #print("___")
-            s.write(z.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
-            s.write(z.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
-            s.write(z.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
+            grbl.send(z)
+            grbl.send(z)
+            grbl.send(z)
+            grbl.flush()
             time.sleep(1)
             thm.make_measurement(**params)
             meas=thm.last_reading
@@ -120,10 +111,9 @@ for k in range(0, n_sizeX-1):
 #rewind; brings back to its own center (must calibrate)
 n_rewind = (n_sizeX - 1 )/2
 for i in range(0, int(n_rewind)):
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-        
\ No newline at end of file
+    grbl.send(z_backwords)
+    grbl.send(z_backwords)
+    grbl.send(z_backwords)
+
+grbl.flush()
+grbl.close()
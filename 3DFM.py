@@ -20,7 +20,7 @@
     Author: Aaron R. Purchase
     Date: 5 May 2021
 '''
-import serial
+from grbl_streamer import GrblStreamer
 import sys
 import os
 
@@ -44,13 +44,8 @@ if __name__ == "__main__":
     for key in thm.id_fields:
         print('{}: {}'.format(key, device_id[key]))
     
-# Open grbl serial port
-s = serial.Serial('/dev/ttyACM0',115200)
-    
-# Wake up grbl
-s.write(b"\r\n\r\n")
-time.sleep(2)   # Wait for grbl to initialize
-s.flushInput()  # Flush startup text in serial input
+# Open and wake up grbl. Lines are streamed: consecutive moves blend in the planner
+grbl = GrblStreamer('/dev/ttyACM0')
     
 w = 1
 
@@ -75,22 +70,15 @@ Bfield_3D_array=np.array([])
 half_steps = int((n_size-1)/2)
 half_stepsZ = int((n_sizeZ-1)/2)
 for z_half in range(0, half_stepsZ):
-    s.write(z_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
+    grbl.send(z_backwords)
 for z_half in range(0, half_steps):
-    s.write(y_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(y_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(y_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
+    grbl.send(y_backwords)
+    grbl.send(y_backwords)
+    grbl.send(y_backwords)
 for z_half in range(0, half_steps):
-    s.write(x_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(x_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
-    s.write(x_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
+    grbl.send(x_backwords)
+    grbl.send(x_backwords)
+    grbl.send(x_backwords)
     
 # Time to map it out in 3D
 for k in range(0, n_sizeZ):
@@ -113,6 +101,7 @@ for k in range(0, n_sizeZ):
         elif (j % 2 != 0 and k % 2 == 0):
             x = x_backwords
             
+        grbl.flush()
         time.sleep(1)
         thm.make_measurement(**params)
         meas=thm.last_reading
@@ -128,12 +117,10 @@ for k in range(0, n_sizeZ):
             #print("x is %s" % (x))
             #print("___")
             w=w+1
-            s.write(x.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
-            s.write(x.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
-            s.write(x.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()
+            grbl.send(x)
+            grbl.send(x)
+            grbl.send(x)
+            grbl.flush()
             time.sleep(1)
             thm.make_measurement(**params)
             meas=thm.last_reading
@@ -146,31 +133,23 @@ for k in range(0, n_sizeZ):
             Bfield_3D_array=np.append(Bfield_3D_array,Bmod[0])
             
             
-        s.write(y.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline()
-        s.write(y.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline() 
-        s.write(y.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline() 
+        grbl.send(y)
+        grbl.send(y)
+        grbl.send(y)
         
-    s.write(z.encode('utf-8') + '\n'.encode('utf-8')) # Send g-code block to grbl
-    grbl_out = s.readline() # Wait for grbl response with carriage return
+    grbl.send(z)
     
     #Complete a y-rewind
     if (y == y_forwords):
         y2 = y_backwords
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline() 
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline()
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline() 
+        grbl.send(y2)
+        grbl.send(y2)
+        grbl.send(y2)
     elif (y == y_backwords):
         y2 = y_forwords
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline()
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline()
-        s.write(y2.encode('utf-8') + '\n'.encode('utf-8'))
-        grbl_out = s.readline() 
-        
\ No newline at end of file
+        grbl.send(y2)
+        grbl.send(y2)
+        grbl.send(y2)
+
+grbl.flush()
+grbl.close()
@@ -3,7 +3,7 @@ import os
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QTabWidget, QWidget, 
                            QVBoxLayout, QHBoxLayout, QLabel, QComboBox, 
                            QPushButton, QSpinBox, QDoubleSpinBox, QLineEdit,
-                           QProgressBar, QFileDialog, QMessageBox, QGroupBox)
+                           QProgressBar, QFileDialog, QMessageBox, QGroupBox, QCheckBox)
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
 import pyqtgraph as pg
 import pyqtgraph.opengl as gl
@@ -13,6 +13,8 @@ import serial
 import serial.tools.list_ports
 import time
 from path_generator import PathGenerator
+from grbl_streamer import GrblStreamer
+from stage_motion import StageMotion
 
 class SetupTab(QWidget):
     def __init__(self):
@@ -102,7 +104,7 @@ class SetupTab(QWidget):
 
             # Test probe connection
             import usbtmc as backend
-            import pyTHM1176.api.thm_usbtmc_api as thm_api
+            from pyTHM1176.api.thm_session import ProbeSession
             devices = backend.list_devices()
             if not devices:
                 raise ConnectionError("THM1176 probe not found")
@@ -114,9 +116,12 @@ class SetupTab(QWidget):
                 "format": "ASCII"
             }
             
-            thm = thm_api.Thm1176(devices[0], **params)
+            # The session keeps the probe open for the measurement runs
+            if getattr(self, 'probe_session', None) is not None:
+                self.probe_session.close()
+            self.probe_session = ProbeSession(devices[0])
+            thm = self.probe_session.acquire(**params)
             device_id = thm.get_id()
-            thm.close()
             
             # Store the serial port for later use
             self.serial_port = port
@@ -343,11 +348,13 @@ class MeasurementThread(QThread):
     measurement_complete = pyqtSignal()
     error_occurred = pyqtSignal(str)
 
-    def __init__(self, path_file, serial_port, probe_params):
+    def __init__(self, path_file, serial_port, probe_params, probe_session=None, absolute_motion=False):
         super().__init__()
         self.path_file = path_file
         self.serial_port = serial_port
         self.probe_params = probe_params
+        self.probe_session = probe_session  # ProbeSession kept open across runs, if any
+        self.absolute_motion = absolute_motion  # move to x, y, z from the work origin stored in GRBL, not by dx, dy, dz
         self.running = False
         self.paused = False
 
@@ -355,10 +362,8 @@ class MeasurementThread(QThread):
         try:
             # Initialize hardware
             self.status_update.emit("Initializing hardware...")
-            s = serial.Serial(self.serial_port, 115200)
-            s.write(b"\r\n\r\n")
-            time.sleep(2)
-            s.flushInput()
+            grbl = GrblStreamer(self.serial_port)
+            motion = StageMotion(grbl)
 
             # Load path file
             self.status_update.emit("Loading path file...")
@@ -366,7 +371,12 @@ class MeasurementThread(QThread):
             total_points = len(df_table)
 
             # Initialize probe
-            thm = thm_api.Thm1176(backend.list_devices()[0], **self.probe_params)
+            if self.probe_session is not None:
+                thm = self.probe_session.acquire(**self.probe_params)
+            else:
+                import usbtmc as backend
+                import pyTHM1176.api.thm_usbtmc_api as thm_api
+                thm = thm_api.Thm1176(backend.list_devices()[0], **self.probe_params)
 
             self.running = True
             current_point = 0
@@ -374,7 +384,7 @@ class MeasurementThread(QThread):
             # Create output file
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             output_filename = f"measurements/measurement_{timestamp}.csv"
-            header = "index,dx,dy,dz,Bx,By,Bz,Bmod,x,y,z\n"
+            header = "index,dx,dy,dz,Bx,By,Bz,Bmod,x,y,z,mx,my,mz\n"
             with open(output_filename, "w") as f:
                 f.write(header)
 
@@ -390,24 +400,25 @@ class MeasurementThread(QThread):
                 # Execute movement
                 self.status_update.emit(f"Moving to position {current_point + 1}/{total_points}")
                 
-                # Create movement command
-                movement_command = f"G91"
-                if row['dx'] != 0:
-                    movement_command += f" X{row['dx']}"
-                if row['dy'] != 0:
-                    movement_command += f" Y{row['dy']}"
-                if row['dz'] != 0:
-                    movement_command += f" Z{row['dz']}"
-                movement_command += " F100000"
-
-                # Send movement command
-                s.write(movement_command.encode('utf-8') + b'\n')
-                s.readline()  # Wait for ok response
-
-                # Wait for movement to complete
-                wait_command = "G4 P0"  # Dwell command to ensure movement completion
-                s.write(wait_command.encode('utf-8') + b'\n')
-                s.readline()
+                # Send movement command, without waiting for its response
+                if self.absolute_motion:
+                    # Absolute move to the position of the path, from the work origin set by "Zero Stage Here"
+                    motion.move_to((row['x'], row['y'], row['z']))
+                else:
+                    movement_command = "G91"
+                    if row['dx'] != 0:
+                        movement_command += f" X{row['dx']}"
+                    if row['dy'] != 0:
+                        movement_command += f" Y{row['dy']}"
+                    if row['dz'] != 0:
+                        movement_command += f" Z{row['dz']}"
+                    movement_command += " F100000"
+                    grbl.send(movement_command)
+
+                # Wait for movement to complete: grbl reporting Idle, at the position it stopped at
+                status = motion.wait_idle()
+                # MPos is missing from the reports of WPos until GRBL has sent its work offset: empty cells then
+                mx, my, mz = status['MPos'][:3] if 'MPos' in status else ("", "", "")
 
                 # Delay based on path file or default
                 delay = row.get('delay', 0.5)
@@ -426,7 +437,7 @@ class MeasurementThread(QThread):
                 # Save measurement to file
                 measurement_line = (f"{index},{row['dx']},{row['dy']},{row['dz']},"
                                  f"{Bx[0]},{By[0]},{Bz[0]},{Bmod[0]},"
-                                 f"{row['x']},{row['y']},{row['z']}\n")
+                                 f"{row['x']},{row['y']},{row['z']},{mx},{my},{mz}\n")
                 with open(output_filename, "a") as f:
                     f.write(measurement_line)
 
@@ -438,8 +449,9 @@ class MeasurementThread(QThread):
                 self.progress_update.emit(progress)
 
             # Clean up
-            s.close()
-            thm.close()
+            grbl.close()
+            if self.probe_session is None:
+                thm.close()
             
             if self.running:  # If we completed normally
                 self.measurement_complete.emit()
@@ -508,7 +520,8 @@ class MainWindow(QMainWindow):
         self.measurement_thread = MeasurementThread(
             path_file=path_file,
             serial_port=self.setup_tab.serial_port,
-            probe_params=probe_params
+            probe_params=probe_params,
+            probe_session=getattr(self.setup_tab, 'probe_session', None)
         )
 
         # Connect thread signals
@@ -597,6 +610,15 @@ class MeasurementTab(QWidget):
         file_layout.addWidget(QLabel("Path File:"))
         file_layout.addWidget(self.path_edit)
         file_layout.addWidget(self.browse_btn)
+
+        # Motion: absolute positions are taken from the work origin stored in GRBL, kept across runs and resets so
+        # that a path can be resumed. It is only changed by "Zero Stage Here", the stage being at the center.
+        motion_layout = QHBoxLayout()
+        self.absolute_check = QCheckBox("Absolute moves (x, y, z)")
+        self.zero_btn = QPushButton("Zero Stage Here")
+        self.zero_btn.clicked.connect(self.zero_stage)
+        motion_layout.addWidget(self.absolute_check)
+        motion_layout.addWidget(self.zero_btn)
         
         # Control buttons
         button_layout = QHBoxLayout()
@@ -613,6 +635,7 @@ class MeasurementTab(QWidget):
         button_layout.addWidget(self.stop_btn)
         
         control_layout.addLayout(file_layout)
+        control_layout.addLayout(motion_layout)
         control_layout.addLayout(button_layout)
         control_group.setLayout(control_layout)
         
@@ -667,7 +690,9 @@ class MeasurementTab(QWidget):
         self.measurement_thread = MeasurementThread(
             path_file=self.path_edit.text(),
             serial_port=setup_tab.serial_port,
-            probe_params=probe_params
+            probe_params=probe_params,
+            probe_session=getattr(setup_tab, 'probe_session', None),
+            absolute_motion=self.absolute_check.isChecked()
         )
 
         # Connect thread signals
@@ -679,6 +704,7 @@ class MeasurementTab(QWidget):
 
         # Update UI
         self.start_btn.setEnabled(False)
+        self.zero_btn.setEnabled(False)
         self.pause_btn.setEnabled(True)
         self.stop_btn.setEnabled(True)
         self.status_label.setText("Starting measurement...")
@@ -686,6 +712,27 @@ class MeasurementTab(QWidget):
         # Start measurement
         self.measurement_thread.start()
 
+    def zero_stage(self):
+        setup_tab = self.window().setup_tab
+        if not hasattr(setup_tab, 'serial_port'):
+            QMessageBox.warning(self, "Warning", "Please connect to hardware first")
+            return
+        reply = QMessageBox.question(self, "Zero Stage",
+                                     "Make the current stage position the work origin?\n"
+                                     "Absolute paths started before will no longer resume at the same positions.")
+        if reply != QMessageBox.Yes:
+            return
+        try:
+            grbl = GrblStreamer(setup_tab.serial_port)
+            try:
+                StageMotion(grbl).zero_here()
+                grbl.flush(timeout=5.0)
+            finally:
+                grbl.close()
+            self.status_label.setText("Work origin set at the current position")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Zeroing failed: {str(e)}")
+
     def pause_measurement(self):
         if self.measurement_thread and self.measurement_thread.isRunning():
             if self.measurement_thread.paused:
@@ -706,6 +753,7 @@ class MeasurementTab(QWidget):
 
     def measurement_complete(self):
         self.start_btn.setEnabled(True)
+        self.zero_btn.setEnabled(True)
         self.pause_btn.setEnabled(False)
         self.stop_btn.setEnabled(False)
         self.pause_btn.setText("Pause")
@@ -714,6 +762,7 @@ class MeasurementTab(QWidget):
 
     def measurement_error(self, error_message):
         self.start_btn.setEnabled(True)
+        self.zero_btn.setEnabled(True)
         self.pause_btn.setEnabled(False)
         self.stop_btn.setEnabled(False)
         self.status_label.setText("Measurement failed")
@@ -0,0 +1,254 @@
+'''
+Fly scan: measuring while the stage moves
+
+Instead of moving, settling and measuring at each point, the stage sweeps each line of a raster at constant feed
+while the THM1176 streams periodic blocks. The GRBL status is polled during the sweep: each report gives the work
+position at the host time it was received. The probe samples are dated in host time too (HostTime, from the probe
+clock model), so their positions are interpolated between the reports. The samples are then averaged onto the grid
+nodes they fall close to.
+Over a field that varies slowly at the scale of the distance covered during one sample, a dense map takes the time of
+the sweeps instead of hours of stop and go.
+
+Moves go through StageMotion, in its path units and scale: absolute in the work coordinates (G90), as is the WPos of
+the reports.
+
+    scan = FlyScan(grbl, thm, feed=300.0)
+    samples = scan.run(raster_lines(-10, 10, np.linspace(-10, 10, 21), [0.0]), **params)
+    grid = bin_to_grid(samples, np.linspace(-10, 10, 41), np.linspace(-10, 10, 21), [0.0])
+'''
+
+import sys
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from grbl_streamer import GrblError, GrblStreamer
+from stage_motion import StageMotion
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+# ################ SETUP #########################
+output_filename = "measurements/fly_scan.csv"
+serial_port = 'COM8'
+emulate_probe = False  # use the software THM1176 instead of the probe
+# Grid positions are relative to the work origin stored in GRBL. zero_at_start makes the position at start that origin
+# (overwriting the one stored): set it to True only with the stage at the center of the table
+zero_at_start = False
+# Grid, in mm: lines are swept along x
+grid_x = np.linspace(-10, 10, 41)
+grid_y = np.linspace(-10, 10, 21)
+grid_z = np.array([0.0])
+feed = 300.0  # mm/min along the lines
+direction_step_sizes = (0.6402, 0.6415, 0.1596)  # machine units per mm, as in measure_table.py
+# Periodic acquisition: 200 samples/s, each averaging within the period
+params = {'trigger_type': 'periodic', 'block_size': 20, 'period': 0.005, 'range': '0.1T', 'average': 50,
+          'format': 'ASCII'}
+
+
+def raster_lines(x_start, x_end, ys, zs):
+    '''
+    Serpentine raster of lines along x
+    :param x_start: x of the lines, in path units
+    :param x_end:
+    :param ys: y of the lines
+    :param zs: z of the planes of lines
+    :return: list of (start, end) points, arrays (x, y, z)
+    '''
+    lines = []
+    for z in zs:
+        for y in ys:
+            if len(lines) % 2 == 0:
+                lines.append((np.array([x_start, y, z]), np.array([x_end, y, z])))
+            else:
+                lines.append((np.array([x_end, y, z]), np.array([x_start, y, z])))
+    return lines
+
+
+def bin_to_grid(samples, xs, ys, zs):
+    '''
+    Average the samples onto the nodes of a regular grid, each sample going to its nearest node
+    :param samples: DataFrame of the samples, with positions x, y, z and fields Bx, By, Bz
+    :param xs: node coordinates along each axis, evenly spaced
+    :param ys:
+    :param zs:
+    :return: DataFrame with, for each node reached, its position, the mean field, Bmod and the number of samples n
+    '''
+    idx = []
+    for key, nodes in zip(('x', 'y', 'z'), (xs, ys, zs)):
+        nodes = np.asarray(nodes, dtype=float)
+        step = nodes[1] - nodes[0] if len(nodes) > 1 else 1.0
+        node_idx = np.rint((samples[key].values - nodes[0]) / step).astype(int)
+        # samples beyond half a step of the grid are dropped
+        node_idx[(node_idx < 0) | (node_idx >= len(nodes))] = -1
+        idx.append(node_idx)
+    keep = np.all(np.array(idx) >= 0, axis=0)
+
+    binned = samples.loc[keep, ['Bx', 'By', 'Bz']].copy()
+    binned['ix'], binned['iy'], binned['iz'] = (node_idx[keep] for node_idx in idx)
+    grid = binned.groupby(['ix', 'iy', 'iz']).agg(Bx=('Bx', 'mean'), By=('By', 'mean'), Bz=('Bz', 'mean'),
+                                                  n=('Bx', 'size')).reset_index()
+    grid.insert(0, 'x', np.asarray(xs, dtype=float)[grid['ix']])
+    grid.insert(1, 'y', np.asarray(ys, dtype=float)[grid['iy']])
+    grid.insert(2, 'z', np.asarray(zs, dtype=float)[grid['iz']])
+    grid['Bmod'] = np.sqrt(grid['Bx'] ** 2 + grid['By'] ** 2 + grid['Bz'] ** 2)
+    return grid.drop(columns=['ix', 'iy', 'iz'])
+
+
+class FlyScan:
+    status_interval = 0.02  # s, between status requests during a sweep
+    timeout_margin = 5.0  # s, allowed beyond the duration of a line at feed before the sweep is given up
+
+    def __init__(self, grbl, thm, feed=300.0, scale=(1.0, 1.0, 1.0)):
+        '''
+
+        :param grbl: GrblStreamer
+        :param thm: Thm1176 instance
+        :param feed: speed along the lines, in path units/min
+        :param scale: machine units per path unit, for each axis
+        '''
+        self.grbl = grbl
+        self.thm = thm
+        self.feed = feed
+        self.motion = StageMotion(grbl, scale=scale)
+
+    def machine_feed(self, start, end):
+        '''
+        GRBL feeds along the machine path: feed scaled by its length relative to the path in path units
+        :param start: start of the move, in path units
+        :param end: end of the move, in path units
+        :return: feed of the move, in machine units/min
+        '''
+        delta = np.asarray(end, dtype=float) - np.asarray(start, dtype=float)
+        return self.feed * np.linalg.norm(delta * self.motion.scale) / np.linalg.norm(delta)
+
+    def record_positions(self, cmd, timeout, reports, done, failed):
+        '''
+        Poll the status until the move of cmd is over, keeping (time, WPos) of each report: as GrblStreamer.wait_idle,
+        the move is over once acknowledged and GRBL reports Idle
+        :param cmd: GrblCommand of the move
+        :param timeout: in s, longest duration of the move
+        '''
+        start = time.monotonic()
+        try:
+            while True:
+                # the state is only conclusive in a report requested after the acknowledgement
+                acknowledged = cmd.done.is_set()
+                status = self.grbl.request_status()
+                # WPos is only known once GRBL has reported its work offset
+                if 'WPos' in status:
+                    reports.append((status['time'], status['WPos'][:3]))
+                if cmd.failed:
+                    raise GrblError("GRBL refused '{}': {}".format(cmd.line, cmd.response))
+                if status['state'].startswith('Alarm'):
+                    raise GrblError("GRBL in alarm state")
+                if acknowledged and status['state'] == 'Idle':
+                    return
+                if time.monotonic() - start > timeout:
+                    raise GrblError("GRBL still in state {} after {} s".format(status['state'], timeout))
+                time.sleep(self.status_interval)
+        except Exception as exc:
+            failed.append(exc)
+        finally:
+            done.set()
+
+    def sweep(self, start, end, **kwargs):
+        '''
+        Sweep one line while streaming the probe
+        :param start: start point, in path units
+        :param end: end point, in path units
+        :param kwargs: setup parameters of the periodic acquisition
+        :return: DataFrame of the samples of the line: HostTime, Bx, By, Bz and their x, y, z in path units
+        '''
+        if np.allclose(start, end):
+            # no move would be sent, nor acknowledged, to end the sweep
+            raise ValueError('Line of zero length from {} to {}'.format(start, end))
+        self.motion.move_to(start)
+        self.motion.wait_idle()
+
+        self.thm.setup(**dict(kwargs, trigger_type='periodic'))
+        timeout = 60 * np.linalg.norm(np.asarray(end, dtype=float) - np.asarray(start, dtype=float)) / self.feed + \
+            self.timeout_margin
+        reports, failed = [], []
+        done = threading.Event()
+        recorder = None
+
+        blocks = []
+        stream = self.thm.iter_blocks()
+        try:
+            cmd = self.motion.move_to(end, self.machine_feed(start, end))
+            recorder = threading.Thread(target=self.record_positions, args=(cmd, timeout, reports, done, failed))
+            recorder.start()
+            for block in stream:
+                blocks.append(block)
+                if done.is_set():
+                    break
+        finally:
+            stream.close()
+            if recorder is not None:
+                recorder.join()
+        if failed:
+            raise failed[0]
+        if not reports:
+            raise GrblError("GRBL reported no work position during the sweep")
+
+        report_times = np.array([report[0] for report in reports])
+        positions = np.array([report[1] for report in reports]) / self.motion.scale
+        samples = pd.DataFrame({key: np.concatenate([block[key] for block in blocks])
+                                for key in ['HostTime'] + self.thm.field_axes})
+        # only the samples between the first and last reports are located
+        times = samples['HostTime'].values
+        samples = samples[(times >= report_times[0]) & (times <= report_times[-1])].copy()
+        for axis, key in enumerate(('x', 'y', 'z')):
+            samples[key] = np.interp(samples['HostTime'].values, report_times, positions[:, axis])
+        return samples
+
+    def run(self, lines, **kwargs):
+        '''
+        Sweep each line of a raster
+        :param lines: list of (start, end) points, in path units, see raster_lines
+        :param kwargs: setup parameters of the periodic acquisition
+        :return: DataFrame of all samples, with the index of their line
+        '''
+        samples = []
+        for line_idx, (start, end) in enumerate(lines):
+            print(f"Line {line_idx + 1}/{len(lines)}: {start} -> {end}")
+            line_samples = self.sweep(start, end, **kwargs)
+            line_samples['line'] = line_idx
+            samples.append(line_samples)
+            print(f"\t{len(line_samples)} samples")
+        return pd.concat(samples, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import usbtmc as backend
+    import pyTHM1176.api.thm_usbtmc_api as thm_api
+    from pyTHM1176.api.thm_emulator import EmulatedThm1176, uniform_field
+
+    if emulate_probe:
+        thm = EmulatedThm1176(latency=1e-3, noise=1e-5, field_model=uniform_field(0.0, 0.0, 0.05), **params)
+    else:
+        thm = thm_api.Thm1176(backend.list_devices()[0], **params)
+    grbl = GrblStreamer(serial_port)
+
+    start = time.time()
+    scan = FlyScan(grbl, thm, feed=feed, scale=direction_step_sizes)
+    if zero_at_start:
+        scan.motion.zero_here()
+    # Lines overrun the grid by half a step, so that the end nodes are reached from both sides
+    half_step = (grid_x[1] - grid_x[0]) / 2
+    samples = scan.run(raster_lines(grid_x[0] - half_step, grid_x[-1] + half_step, grid_y, grid_z), **params)
+    grid = bin_to_grid(samples, grid_x, grid_y, grid_z)
+    print(f"{len(samples)} samples on {len(grid)} grid points in {time.time() - start:.0f} s")
+
+    # Field in G, as the other measurement files
+    for key in ['Bx', 'By', 'Bz', 'Bmod']:
+        grid[key] *= 10000
+    grid.index.name = 'index'
+    grid.to_csv(output_filename)
+    print("Saved to", output_filename)
+
+    thm.close()
+    grbl.close()
@@ -0,0 +1,281 @@
+'''
+Streaming of g-code to GRBL with character counting
+
+Sending a line and waiting for its 'ok' before sending the next one leaves GRBL's planner with a single block: the
+machine stops at the end of every segment, and each line costs a serial round trip. GRBL acknowledges a line once it
+has been taken out of its 128 byte serial RX buffer, so the host can instead keep sending lines as long as the
+characters of the lines not acknowledged yet fit in that buffer. The planner then always has the next blocks and
+blends consecutive moves, and the serial latency overlaps the motion.
+
+Responses ('ok' or 'error:N') come back in the order of the lines. A reader thread matches each one to the oldest
+line in flight, so sending never waits for a response, only for room in the buffer. Status reports are kept in status,
+other messages (startup banner, '[MSG:...]', 'ALARM:N') in messages.
+
+Waiting for 'ok' to 'G4 P0' only tells that the motion is over with the latency of a planner sync. wait_idle instead
+polls the real-time status report ('?', answered even while GRBL is busy) until it reads Idle, and returns that report:
+its MPos is the actual position the machine stopped at.
+
+    grbl = GrblStreamer('COM8')
+    for line in lines:
+        grbl.send(line)
+    status = grbl.wait_idle()  # once the motion is complete
+    print(status['MPos'])
+    grbl.close()
+'''
+
+import re
+import collections
+import threading
+import time
+import serial
+import numpy as np
+
+status_field_pattern = re.compile(r'([A-Za-z]+):([^|,]+(?:,[-\d.]+)*)')
+
+
+def parse_status(report, received=None):
+    '''
+    Parse a status report, of GRBL 1.1 ('<Idle|MPos:0.000,0.000,0.000|FS:0,0>') or 0.9
+    ('<Idle,MPos:0.000,0.000,0.000,WPos:0.000,0.000,0.000>')
+    :param report: line received, with its brackets
+    :param received: host monotonic time the report was received at, in s
+    :return: dict with the machine 'state' (e.g. 'Idle', 'Run', 'Hold:0', 'Alarm'), the report 'time', and an array
+    for each numerical field (e.g. 'MPos', 'WPos', 'WCO', 'FS')
+    '''
+    body = report.strip()[1:-1]
+    state, _, fields = body.partition('|' if '|' in body else ',')
+    status = {'state': state, 'time': received}
+    for key, values in status_field_pattern.findall(fields):
+        try:
+            status[key] = np.array([float(value) for value in values.split(',')])
+        except ValueError:
+            status[key] = values
+    return status
+
+
+class GrblError(Exception):
+    pass
+
+
+class GrblCommand:
+    '''
+    Line sent to GRBL, and its response once received
+    '''
+
+    def __init__(self, line):
+        self.line = line
+        self.length = len(line) + 1  # with the newline
+        self.response = None
+        self.done = threading.Event()
+
+    @property
+    def failed(self):
+        return self.response is not None and self.response != 'ok'
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the response
+        :param timeout: in s, None to wait forever
+        :return: response
+        '''
+        if not self.done.wait(timeout):
+            raise GrblError("No response from GRBL to '{}'".format(self.line))
+        if self.failed:
+            raise GrblError("GRBL refused '{}': {}".format(self.line, self.response))
+        return self.response
+
+
+class GrblStreamer:
+    rx_buffer_size = 128  # bytes of the GRBL serial RX buffer
+    read_timeout = 0.1  # s, period at which the reader thread checks for closing
+    poll_interval = 0.02  # s, between status requests while waiting for Idle
+
+    def __init__(self, port, baudrate=115200, connection=None):
+        '''
+
+        :param port: serial port of GRBL
+        :param baudrate:
+        :param connection: already opened serial connection (or object with the same read/write interface, reads
+        timing out) to use instead of opening port
+        '''
+        if connection is None:
+            connection = serial.Serial(port, baudrate, timeout=self.read_timeout)
+            # Wake up grbl
+            connection.write(b"\r\n\r\n")
+            time.sleep(2)  # Wait for grbl to initialize
+            connection.reset_input_buffer()  # Flush startup text in serial input
+        self.serial = connection
+
+        self.in_flight = collections.deque()  # commands sent, not acknowledged yet
+        self.in_flight_chars = 0
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.errors = []  # commands refused since the last flush
+        self.messages = collections.deque(maxlen=100)  # lines received that are not responses
+        self.status = None  # last status report, see parse_status
+        self.status_count = 0  # number of status reports received
+        self.work_offset = None  # last WCO reported, GRBL 1.1 only sending it from time to time
+
+        self.running = True
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    def send(self, line, timeout=None):
+        '''
+        Send a line as soon as it fits in the GRBL RX buffer, without waiting for its response
+        :param line: g-code line, without newline
+        :param timeout: in s, longest wait for room in the buffer, None to wait forever
+        :return: GrblCommand, to wait for the response if needed
+        '''
+        cmd = GrblCommand(line.strip())
+        if cmd.length > self.rx_buffer_size:
+            raise GrblError("Line longer than the GRBL buffer: '{}'".format(cmd.line))
+
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.in_flight_chars + cmd.length <= self.rx_buffer_size or not self.running, timeout):
+                raise GrblError("GRBL buffer still full after {} s".format(timeout))
+            if not self.running:
+                raise GrblError("GRBL streamer closed")
+            # Queued before being written, so that the response cannot arrive before
+            self.in_flight.append(cmd)
+            self.in_flight_chars += cmd.length
+            with self.write_lock:
+                self.serial.write((cmd.line + '\n').encode('utf-8'))
+        return cmd
+
+    def command(self, line, timeout=None):
+        '''
+        Send a line and wait for its response, e.g. for 'G4 P0' which is only acknowledged once the motion planned
+        before it is complete
+        :return: response
+        '''
+        cmd = self.send(line)
+        try:
+            return cmd.wait(timeout)
+        finally:
+            with self.condition:
+                # reported here, not again by flush
+                if cmd in self.errors:
+                    self.errors.remove(cmd)
+
+    def write_realtime(self, char):
+        '''
+        Send a real-time command ('?', '!', '~', ...): it bypasses the RX buffer and is not acknowledged
+        '''
+        with self.write_lock:
+            self.serial.write(char.encode('utf-8'))
+
+    def request_status(self, timeout=1.0):
+        '''
+        Request a status report and wait for it
+        :param timeout: in s
+        :return: status, see parse_status
+        '''
+        with self.condition:
+            count = self.status_count
+        self.write_realtime('?')
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.status_count > count or not self.running, timeout):
+                raise GrblError("No status report from GRBL after {} s".format(timeout))
+            if not self.running:
+                raise GrblError("GRBL streamer closed")
+            return self.status
+
+    def wait_idle(self, timeout=None, poll_interval=None):
+        '''
+        Wait for the motion to be complete: all the lines sent acknowledged, then GRBL reporting Idle
+        :param timeout: in s, None to wait forever
+        :param poll_interval: in s, between status requests, poll_interval of the class if None
+        :return: the Idle status, with the position the machine stopped at
+        '''
+        if poll_interval is None:
+            poll_interval = self.poll_interval
+        start = time.monotonic()
+        self.flush(timeout)
+        while True:
+            status = self.request_status()
+            if status['state'] == 'Idle':
+                return status
+            if status['state'].startswith('Alarm'):
+                raise GrblError("GRBL in alarm state")
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise GrblError("GRBL still in state {} after {} s".format(status['state'], timeout))
+            time.sleep(poll_interval)
+
+    def flush(self, timeout=None):
+        '''
+        Wait for the responses to all the lines sent, i.e. until they are all in the planner
+        :param timeout: in s, None to wait forever
+        :return:
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.in_flight or not self.running, timeout):
+                raise GrblError("GRBL did not acknowledge {} lines after {} s".format(len(self.in_flight), timeout))
+            errors, self.errors = self.errors, []
+        if errors:
+            raise GrblError("GRBL refused " + ", ".join("'{}': {}".format(cmd.line, cmd.response) for cmd in errors))
+
+    def handle_line(self, line):
+        '''
+        Dispatch a line received from GRBL
+        '''
+        if line.startswith('<') and line.endswith('>'):
+            status = parse_status(line, time.monotonic())
+            if 'WCO' in status:
+                self.work_offset = status['WCO']
+            if self.work_offset is not None:
+                # only one of the positions is reported, depending on $10
+                if 'MPos' not in status and 'WPos' in status:
+                    status['MPos'] = status['WPos'] + self.work_offset
+                elif 'WPos' not in status and 'MPos' in status:
+                    status['WPos'] = status['MPos'] - self.work_offset
+            with self.condition:
+                self.status = status
+                self.status_count += 1
+                self.condition.notify_all()
+        elif line == 'ok' or line.startswith('error'):
+            with self.condition:
+                if not self.in_flight:
+                    self.messages.append(line)
+                    return
+                cmd = self.in_flight.popleft()
+                self.in_flight_chars -= cmd.length
+                cmd.response = line
+                if cmd.failed:
+                    self.errors.append(cmd)
+                self.condition.notify_all()
+            cmd.done.set()
+        else:
+            if line.startswith('ALARM'):
+                print("GRBL", line)
+            self.messages.append(line)
+
+    def read_responses(self):
+        pending = b''
+        while self.running:
+            try:
+                data = self.serial.readline()
+            except (serial.SerialException, OSError, TypeError):
+                # port closed
+                break
+            if not data:
+                continue
+            pending += data
+            if not pending.endswith(b'\n'):
+                # read timed out within a line
+                continue
+            line, pending = pending.decode('utf-8', errors='replace').strip(), b''
+            if line:
+                self.handle_line(line)
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.reader.join()
+        self.serial.close()
@@ -1,4 +1,3 @@
-import serial
 import sys
 import os
 import time
@@ -6,6 +5,11 @@ import pandas as pd
 import numpy as np
 import usbtmc as backend
 import pyTHM1176.api.thm_usbtmc_api as thm_api
+from pyTHM1176.api.thm_emulator import EmulatedThm1176, uniform_field
+from pyTHM1176.api.auto_range import AutoRanger
+from grbl_streamer import GrblStreamer
+from settle_scheduler import SettleScheduler, wait_stable
+from stage_motion import StageMotion
 
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -18,14 +22,42 @@ output_filename = "measurements/sphere_35radius_64points_1perPos_measurements_pa
 # table_filename = "movement_paths/20cube_2samples_1measurements_per_pos.csv"
 # output_filename = "measurements/test_cube.csv"
 move_motors = True
-move_in_increments = False
+# Move to the absolute x, y, z of each row (G90, see stage_motion.py) rather than by its dx, dy, dz (G91): rows can then
+# be reordered, and a scan resumed at start_index. The positions are relative to the work origin stored in GRBL:
+# zero_at_start makes the position at start that origin (overwriting the one stored), so set it to True only for the
+# first run of a table, the stage being at its center, and leave it False to resume an interrupted run
+absolute_motion = False
+zero_at_start = False
+start_index = 0  # first row of the table to measure, the output file being appended to if not 0
+move_in_increments = False  # relative motion only
 send_external_trigger = False
 measure_probe = True  # NB: before changing this, make sure you aren't overwriting a previous measurement output file!
+emulate_probe = False  # use the software THM1176 instead of the probe (no hardware needed, e.g. for timing runs)
+burst_repeats = True  # measure the consecutive rows at a same position (measurements_per_pos > 1) with a single burst
+# Target standard error of each field axis, in T: average each point only until it is reached, 'average' of the
+# probe parameters being then the upper bound. None to always average 'average' times
+target_std_error = None
+# Switch the probe range on overload or underuse, remembering the range per cube of auto_range_cell mm of the table
+# positions. 'range' of the probe parameters is then only the range of the first point
+auto_range = False
+auto_range_cell = 5.0
 default_measurement_delay = 0.5  # default time delay for measurement, often will be overwritten by the table file
+# After the delay, measure with stable_average until two successive readings agree within settle_tolerance (T), up to
+# settle_timeout s. None to trust the delay
+settle_tolerance = None
+settle_timeout = 5.0
+stable_average = 1000
+# Delay of each row from the vibration decay of the stage (settle_scheduler.py) instead of the delay of the table. The
+# decay is fitted at start after the relative moves of settle_calibration (mm, there and back), recorded every 10 ms
+# with settle_average, or given as settle_gain and settle_tau printed by an earlier calibration. None to use the table
+settle_calibration = None  # e.g. [(1, 0, 0), (-1, 0, 0), (10, 0, 0), (-10, 0, 0)]
+settle_average = 100
+settle_gain = None
+settle_tau = None
 
 # Trigger commands to trigger the spindle direction pin
-trigger_cmd_hi = "M4 S0".encode('utf-8') + '\n'.encode('utf-8')
-trigger_cmd_lo = "M3 S0".encode('utf-8') + '\n'.encode('utf-8')
+trigger_cmd_hi = "M4 S0"
+trigger_cmd_lo = "M3 S0"
 
 direction_step_sizes = {  # These were calibrated manually
     "dx": 0.6402,
@@ -35,125 +67,202 @@ direction_step_sizes = {  # These were calibrated manually
 if __name__ == "__main__":
 
     # ################# SETUP MOTORS ########################
-    # Open grbl serial port
+    # Open and wake up grbl. Moves are streamed, without waiting for each one to be acknowledged
     if move_motors or send_external_trigger:
-        s = serial.Serial('COM8', 115200)
-        s.write(b"\r\n\r\n")
-        time.sleep(2)   # Wait for grbl to initialize
-        s.flushInput()  # Flush startup text in serial input
+        grbl = GrblStreamer('COM8')
+        motion = StageMotion(grbl, scale=list(direction_step_sizes.values()))
+        if move_motors and absolute_motion and zero_at_start:
+            motion.zero_here()
 
         # If sending external pulses, set the output pin to low to prepare for pulses
         if send_external_trigger:
-            s.write(trigger_cmd_lo)
-            s.readline()
+            grbl.command(trigger_cmd_lo)
 
     # ################## SETUP PROBE #######################
     if measure_probe:
-        params = {"trigger_type": "single", 'range': '0.1T', 'average': 30000, 'format': 'ASCII'}
+        # Only the field is written out: timestamp and temperature are left out of the fetches
+        params = {"trigger_type": "single", 'range': '0.1T', 'average': 30000, 'format': 'ASCII',
+                  'fetch_timestamp': False, 'temperature_every': 0}
 
-        thm = thm_api.Thm1176(backend.list_devices()[0], **params)
+        if emulate_probe:
+            thm = EmulatedThm1176(latency=1e-3, noise=1e-5, field_model=uniform_field(0.0, 0.0, 0.05), **params)
+        else:
+            thm = thm_api.Thm1176(backend.list_devices()[0], **params)
         # Get device id string and print output. This can be used to check communications are OK
         device_id = thm.get_id()
         for key in thm.id_fields:
             print('{}: {}'.format(key, device_id[key]))
+        ranger = AutoRanger(thm, cell_size=auto_range_cell) if auto_range else None
+
+    # ################## SETTLING DELAYS #######################
+    settle = None
+    if settle_gain is not None:
+        settle = SettleScheduler(gain=settle_gain, tau=settle_tau)
+    elif settle_calibration is not None and move_motors and measure_probe:
+        settle = SettleScheduler()
+        print("Calibrating the settling time on", len(settle_calibration), "moves...")
+        settle.calibrate(motion, thm, settle_calibration, period=0.01, **dict(params, average=settle_average))
+        print("Settling: gain", settle.gain, "tau", settle.tau, "s")
 
     # #########################################
     # Load data file
     df_table = pd.read_csv(table_filename)
 
+    # Rows that do not move belong to the position of the previous row: count the rows measured at each position
+    moved = (df_table["dx"] != 0) | (df_table["dy"] != 0) | (df_table["dz"] != 0)
+    position_group = moved.cumsum()
+    # (from each row to the end of its position, so that a scan can be resumed within a position)
+    rows_at_position = position_group.groupby(position_group).cumcount(ascending=False) + 1
+    burst_samples = []  # samples of the last burst, still to be written for the next rows
+    field_range = ""  # range of the last measurement
+    machine_position = ["", "", ""]  # MPos reported by grbl at the end of the last move
+
     # Set up save file
     print("Saving measurement to file", output_filename)
-    string_to_write = ",".join(["index", "dx", "dy", "dz", "Bx", "By", "Bz", "Bmod", "x", "y", "z", "trigger", "\n"])
-    with open(output_filename, "w") as f:
-        f.write(string_to_write)
+    if start_index == 0:
+        string_to_write = ",".join(["index", "dx", "dy", "dz", "Bx", "By", "Bz", "Bmod", "x", "y", "z", "trigger",
+                                    "dBx", "dBy", "dBz", "range", "mx", "my", "mz", "\n"])
+        with open(output_filename, "w") as f:
+            f.write(string_to_write)
 
     # #########################################
     for index, row in df_table.iterrows():
         command_num = row["index"]
-        if "delay" in row:
+        if index < start_index:
+            continue
+
+        if burst_samples:
+            # Repeated measurement at the same position, already acquired by the last burst
+            Bx, By, Bz = burst_samples.pop(0)
+            Bmod = np.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
+            print(f"\n{int(command_num)}", "- burst sample ---> Measurement:", Bx, By, Bz, Bmod)
+            string_to_write = ",".join(
+                [str(command_num), str(row["dx"]), str(row["dy"]), str(row["dz"]),
+                 str(Bx[0]), str(By[0]), str(Bz[0]), str(Bmod[0]),
+                 str(row["x"]), str(row["y"]), str(row["z"]),
+                 str(send_external_trigger), "", "", "", field_range, *machine_position, "\n"])
+            with open(output_filename, "a") as f:
+                f.write(string_to_write)
+            continue
+
+        if settle is not None:
+            measurement_delay = float(settle.delays(row["dx"], row["dy"], row["dz"]))
+        elif "delay" in row:
             measurement_delay = row["delay"]
         else:
             measurement_delay = default_measurement_delay
         print(f"\n{int(command_num)}", "- move to:", row["x"], row["y"], row["z"], "---------------------------------------")
         print("\tdelay", measurement_delay, "--- dx, dy, dz:", row["dx"], ",", row["dy"], ",", row["dz"])
-        # Cycle through each direction (x, y, z)
-        amts_to_move = []
-        movement_command = "G91"
-        for direction in direction_step_sizes.keys():
-            amt_to_move_mm = row[direction]
-            if amt_to_move_mm == 0:
-                continue
-
-            # Do the movement:
-            if move_in_increments:
-                # assert amt_to_move_mm % 1 == 0, f"Found non-integer step size for {direction}: {amt_to_move_mm}"
-                num_steps = int(np.abs(amt_to_move_mm))
-                if np.sign(amt_to_move_mm) > 0:
-                    sign = ""
+        if absolute_motion:
+            # Straight to the position of the row, whatever the rows before it
+            print("\tAbsolute move to", row["x"], row["y"], row["z"], "; delay", measurement_delay)
+            if move_motors:
+                motion.move_to((row["x"], row["y"], row["z"]))
+        else:
+            # Cycle through each direction (x, y, z)
+            amts_to_move = []
+            movement_command = "G91"
+            for direction in direction_step_sizes.keys():
+                amt_to_move_mm = row[direction]
+                if amt_to_move_mm == 0:
+                    continue
+
+                # Do the movement:
+                if move_in_increments:
+                    # assert amt_to_move_mm % 1 == 0, f"Found non-integer step size for {direction}: {amt_to_move_mm}"
+                    num_steps = int(np.abs(amt_to_move_mm))
+                    if np.sign(amt_to_move_mm) > 0:
+                        sign = ""
+                    else:
+                        sign = "-"
+                    movement_command = f"G91 {direction.replace('d','').upper()}{sign}{direction_step_sizes[direction]} F100000"
+                    print("\tSTART: incremental move", direction, "move:", amt_to_move_mm,
+                          "--> CMD:", movement_command, "\tnum steps:", num_steps)
+                    if move_motors:
+                        amount_moved = 0
+                        for step_idx in range(num_steps):
+                            amount_moved += 1
+                            grbl.send(movement_command)
+                        amount_left_to_move = np.abs(amt_to_move_mm) - amount_moved
+                        scaled_movement = amount_left_to_move * direction_step_sizes[direction]
+                        movement_command = f"G91 {direction.replace('d', '').upper()}{sign}{scaled_movement} F100000"
+                        print("\tFINAL: incremental move", direction, "move:", amount_left_to_move,
+                              "--> CMD:", movement_command)
+                        grbl.send(movement_command)
+                        print(f"\tFinished, total movement: {sign}{amount_left_to_move + amount_moved}")
                 else:
-                    sign = "-"
-                movement_command = f"G91 {direction.replace('d','').upper()}{sign}{direction_step_sizes[direction]} F100000"
-                print("\tSTART: incremental move", direction, "move:", amt_to_move_mm,
-                      "--> CMD:", movement_command, "\tnum steps:", num_steps)
+                    # print("Doing single scaled movement")
+                    scaled_movement = amt_to_move_mm * direction_step_sizes[direction]
+                    movement_command += f" {direction.replace('d','').upper()}{scaled_movement}"
+                    amts_to_move.append(amt_to_move_mm)
+
+            if not move_in_increments:
+                movement_command += " F100000"
+                print("\tSingle move --- ",  # "move:", amts_to_move,
+                      "; CMD:", movement_command,
+                      "; delay", measurement_delay)
                 if move_motors:
-                    amount_moved = 0
-                    for step_idx in range(num_steps):
-                        amount_moved += 1
-                        s.write(movement_command.encode('utf-8') + '\n'.encode('utf-8'))
-                        grbl_out = s.readline()
-                    amount_left_to_move = np.abs(amt_to_move_mm) - amount_moved
-                    scaled_movement = amount_left_to_move * direction_step_sizes[direction]
-                    movement_command = f"G91 {direction.replace('d', '').upper()}{sign}{scaled_movement} F100000"
-                    print("\tFINAL: incremental move", direction, "move:", amount_left_to_move,
-                          "--> CMD:", movement_command)
-                    s.write(movement_command.encode('utf-8') + '\n'.encode('utf-8'))
-                    grbl_out = s.readline()
-                    print(f"\tFinished, total movement: {sign}{amount_left_to_move + amount_moved}")
-            else:
-                # print("Doing single scaled movement")
-                scaled_movement = amt_to_move_mm * direction_step_sizes[direction]
-                movement_command += f" {direction.replace('d','').upper()}{scaled_movement}"
-                amts_to_move.append(amt_to_move_mm)
-
-        if not move_in_increments:
-            movement_command += " F100000"
-            print("\tSingle move --- ",  # "move:", amts_to_move,
-                  "; CMD:", movement_command,
-                  "; delay", measurement_delay)
-            if move_motors:
-                s.write(movement_command.encode('utf-8') + '\n'.encode('utf-8'))
-                grbl_out = s.readline()
+                    grbl.send(movement_command)
 
         # Wait for motion to stop and delay before measurement
         if move_motors:
             print("\t...Wait for move to finish...")
-            wait_command = "G4 P0"  # "Dwell" for 0 s. This cmd delays the rest of the code until motors finish moving
-            s.write(wait_command.encode('utf-8') + '\n'.encode('utf-8'))
-            grbl_out = s.readline()  # This only runs once the motors finish moving.
+            # Poll the status until grbl reports Idle: the settling delay starts from the actual end of the motion
+            status = motion.wait_idle()
+            # MPos is missing from the reports of WPos ($10) until GRBL has sent its work offset: empty cells then
+            mpos = status.get("MPos")
+            machine_position = ["", "", ""] if mpos is None else [str(value) for value in mpos[:3]]
 
-            print("\tFinished moving... Delaying", measurement_delay, "s...")
+            print("\tFinished moving at", mpos, "... Delaying", measurement_delay, "s...")
             time.sleep(measurement_delay)  # Delay for the amount of specified time
             print("\tFinished delaying.")
 
+            if measure_probe and settle_tolerance is not None:
+                stable = wait_stable(thm, settle_tolerance, settle_timeout, **dict(params, average=stable_average))
+                if stable:
+                    print("\tField stable")
+                else:
+                    print("\tField still not stable after", settle_timeout, "s")
+
         # Send a trigger for a measurement
         if send_external_trigger:
             print("\tSending external trigger")  # Takes about 2-5 ms for the pulse to go
-            s.write(trigger_cmd_hi)
-            s.readline()
-            s.write(trigger_cmd_lo)
-            s.readline()
+            grbl.command(trigger_cmd_hi)
+            grbl.command(trigger_cmd_lo)
             print("\tSleep for 1 ms after trigger")
             time.sleep(0.001)  # Wait 1 ms for trigger
 
         # Make the measurement
         if measure_probe:
-            print("\tMaking measurement")
-            thm.make_measurement(**params)
+            n_samples = rows_at_position[index] if burst_repeats and not send_external_trigger else 1
+            uncertainty = ["", "", ""]
+            if n_samples > 1:
+                print("\tMaking burst of", n_samples, "measurements")
+                method, args = thm.make_burst_measurement, (n_samples,)
+            elif target_std_error is not None and not send_external_trigger:
+                method, args = thm.make_adaptive_measurement, (target_std_error,)
+            else:
+                print("\tMaking measurement")
+                method, args = thm.make_measurement, ()
+
+            if ranger is not None:
+                remeasured = ranger.n_remeasured
+                field_range, result = ranger.measure((row["x"], row["y"], row["z"]), params, method, *args)
+                print("\tRange", field_range, "- remeasured", ranger.n_remeasured - remeasured, "times")
+            else:
+                result = method(*args, **params)
+                field_range = params['range']
+            if method == thm.make_adaptive_measurement:
+                print("\tMade adaptive measurement, averaging", result["Bx"]["average"])
+                uncertainty = [str(thm.last_uncertainty[key] * 10000) for key in thm.field_axes]
             meas = thm.last_reading
             measurements = list(meas.values())
             Bx = np.array(measurements[0])*10000
             By = np.array(measurements[1])*10000
             Bz = np.array(measurements[2])*10000
+            # Keep the other samples of the burst for the next rows
+            burst_samples = [(Bx[k:k + 1], By[k:k + 1], Bz[k:k + 1]) for k in range(1, len(Bx))]
+            Bx, By, Bz = Bx[:1], By[:1], Bz[:1]
             Bmod = np.sqrt(Bx**2 + By**2 + Bz**2)
 
             print("\t ---> Measurement:", Bx, By, Bz, Bmod)
@@ -170,6 +279,9 @@ if __name__ == "__main__":
                  str(row["y"]),
                  str(row["z"]),
                  str(send_external_trigger),
+                 *uncertainty,
+                 field_range,
+                 *machine_position,
                  "\n"
                  ])
             with open(output_filename, "a") as f:
@@ -180,6 +292,6 @@ if __name__ == "__main__":
 
     # Close connections
     if move_motors or send_external_trigger:
-        s.close()
+        grbl.close()
 
     print("Finished")
@@ -4,8 +4,8 @@ import math
 
 class PathGenerator:
     @staticmethod
-    def generate_cube_path(size_mm, points_per_side, measurements_per_pos=1):
-        """Generate a cubic measurement path"""
+    def generate_cube_path(size_mm, points_per_side, measurements_per_pos=1, settle=None):
+        """Generate a cubic measurement path, delays from settle (SettleScheduler) if given"""
         half_length = size_mm / 2
         
         # Generate points
@@ -43,20 +43,14 @@ class PathGenerator:
         })
         
         # Add delays and indices
-        df_diff["delay"] = 1
-        df_diff.loc[(np.abs(df_diff["dx"]) > 10) |
-                   (np.abs(df_diff["dy"]) > 10) |
-                   (np.abs(df_diff["dz"]) > 10), "delay"] = 3
-        df_diff.loc[(np.abs(df_diff["dx"]) == 0) &
-                   (np.abs(df_diff["dy"]) == 0) &
-                   (np.abs(df_diff["dz"]) == 0), "delay"] = 0
+        PathGenerator.assign_delays(df_diff, settle)
         df_diff["index"] = np.arange(len(df_diff))
         
         return df_diff
 
     @staticmethod
-    def generate_sphere_path(radius, num_points_theta, num_points_phi, measurements_per_pos=1):
-        """Generate a spherical measurement path"""
+    def generate_sphere_path(radius, num_points_theta, num_points_phi, measurements_per_pos=1, settle=None):
+        """Generate a spherical measurement path, delays from settle (SettleScheduler) if given"""
         # Generate spherical coordinates
         thetas = np.linspace(0, 360, num_points_theta + 1)[:-1]
         phis = np.linspace(0, 180, num_points_phi + 1)[:-1]
@@ -101,6 +95,19 @@ class PathGenerator:
         })
         
         # Add delays and indices
+        PathGenerator.assign_delays(df_diff, settle)
+        df_diff["index"] = np.arange(len(df_diff))
+        
+        return df_diff
+
+    @staticmethod
+    def assign_delays(df_diff, settle=None):
+        """Set the delay after each move: from the settle scheduler, or 0 s without move, 3 s after moves over 10 mm
+        and 1 s otherwise"""
+        if settle is not None:
+            df_diff["delay"] = settle.delays(df_diff["dx"], df_diff["dy"], df_diff["dz"])
+            return
+
         df_diff["delay"] = 1
         df_diff.loc[(np.abs(df_diff["dx"]) > 10) |
                    (np.abs(df_diff["dy"]) > 10) |
@@ -108,9 +115,6 @@ class PathGenerator:
         df_diff.loc[(np.abs(df_diff["dx"]) == 0) &
                    (np.abs(df_diff["dy"]) == 0) &
                    (np.abs(df_diff["dz"]) == 0), "delay"] = 0
-        df_diff["index"] = np.arange(len(df_diff))
-        
-        return df_diff
 
     @staticmethod
     def get_preview_points(df):
@@ -0,0 +1,93 @@
+'''
+Automatic range selection of the THM1176, remembered per region of space
+
+A measurement whose largest field component comes close to the full scale of the range is overloaded: it is redone
+on the next range up. One that would fit with margin in the next range down underuses the range: it is redone on that
+range, for a finer resolution. The range finally used is remembered for the cell of space the point lies in, and
+later points of the same (or, failing that, of the nearest known) cell start from it, so that trial and error only
+happens where the field changes of scale.
+Field values are checked in T, so the probe must be used in ASCII format (INTEGER readings are raw counts).
+
+    ranger = AutoRanger(thm, cell_size=5.0)
+    field_range, result = ranger.measure((x, y, z), params)
+'''
+
+import numpy as np
+
+
+class AutoRanger:
+
+    def __init__(self, thm, cell_size=5.0, overload=0.95, margin=0.7):
+        '''
+
+        :param thm: Thm1176 instance
+        :param cell_size: edge of the cubic cells the range is remembered for, in the unit of the positions
+        :param overload: fraction of the full scale above which a measurement is overloaded
+        :param margin: fraction of the full scale of the next range down below which a measurement underuses its
+        range. Keep it under overload, so that the range does not switch back and forth.
+        '''
+        self.thm = thm
+        self.cell_size = cell_size
+        self.overload = overload
+        self.margin = margin
+        self.cell_ranges = {}  # cell index -> range
+        self.n_remeasured = 0  # measurements redone on another range
+
+    def cell(self, position):
+        return tuple(int(idx) for idx in np.floor(np.asarray(position, dtype=float) / self.cell_size))
+
+    def initial_range(self, position, default):
+        '''
+        Range of the cell of position, or of the nearest cell with a known range, or default
+        '''
+        cell = self.cell(position)
+        if cell in self.cell_ranges:
+            return self.cell_ranges[cell]
+        if not self.cell_ranges:
+            return default
+
+        cells = np.array(list(self.cell_ranges.keys()))
+        nearest = np.argmin(np.sum((cells - cell) ** 2, axis=1))
+        return self.cell_ranges[tuple(cells[nearest])]
+
+    def peak_field(self):
+        return max(np.nanmax(np.abs(np.asarray(self.thm.last_reading[key], dtype=float)))
+                   for key in self.thm.field_axes)
+
+    def measure(self, position, params, method=None, *args):
+        '''
+        Measure at position, on the range remembered for its neighbourhood, switching range and measuring again
+        while the measurement is overloaded or underuses its range
+        :param position: (x, y, z) position of the point
+        :param params: setup parameters, the 'range' being the one used where no range is known yet
+        :param method: measurement method of the Thm1176 instance, make_measurement if None
+        :param args: positional arguments of method, before the setup parameters
+        :return: (range of the measurement left in thm.last_reading, what method returned for it)
+        '''
+        self.thm.require_tesla('Auto-ranging', params)
+        if method is None:
+            method = self.thm.make_measurement
+        ranges = self.thm.ranges
+        field_range = self.initial_range(position, params.get('range', self.thm.range))
+        tried = set()
+
+        while True:
+            result = method(*args, **dict(params, range=field_range))
+            tried.add(field_range)
+            peak = self.peak_field()
+            idx = ranges.index(field_range)
+
+            if peak >= self.overload * self.thm.full_scales[field_range] and idx + 1 < len(ranges):
+                next_range = ranges[idx + 1]
+            elif idx > 0 and peak < self.margin * self.thm.full_scales[ranges[idx - 1]]:
+                next_range = ranges[idx - 1]
+            else:
+                break
+
+            if next_range in tried:
+                break
+            field_range = next_range
+            self.n_remeasured += 1
+
+        self.cell_ranges[self.cell(position)] = field_range
+        return field_range, result
@@ -0,0 +1,92 @@
+'''
+Parser of THM1176 ASCII fetch responses
+
+A parser is compiled once for a given fetch layout (fetched kinds, number of samples per block, trigger period) and
+turns each response into a preallocated structured record in a single pass over the text: unit suffixes are dropped
+and separators unified by one str.translate, then all field values are converted at once.
+The record is reused from one response to the next, copy it to keep a reading.
+
+A FetchLayout tells which quantities are transferred: some of the field axes, the timestamp or not, and the
+temperature on every Nth fetch only. Quantities not fetched are NaN in the record, except the temperature which keeps
+its last fetched value.
+'''
+
+import numpy as np
+
+
+class FetchLayout:
+    axis_kinds = {'X': 'Bx', 'Y': 'By', 'Z': 'Bz'}
+
+    def __init__(self, axes='XYZ', timestamp=True, temperature_every=1):
+        '''
+
+        :param axes: field axes to fetch, e.g. 'XYZ' or 'Z'
+        :param timestamp: fetch the timestamp of the block
+        :param temperature_every: fetch the temperature every temperature_every fetches, 0 to never fetch it
+        '''
+        self.axes = [axis for axis in 'XYZ' if axis in axes.upper()]
+        if not self.axes:
+            raise ValueError('A fetch layout needs at least one field axis')
+        self.field_kinds = [self.axis_kinds[axis] for axis in self.axes]
+        self.timestamp = bool(timestamp)
+        self.temperature_every = int(temperature_every)
+        self.key = (tuple(self.axes), self.timestamp, self.temperature_every)
+
+    def has_temperature(self, fetch_index):
+        '''
+        :param fetch_index: number of fetches done before this one
+        :return: True if the temperature is fetched this time
+        '''
+        return self.temperature_every > 0 and fetch_index % self.temperature_every == 0
+
+
+class AsciiFetchParser:
+    translation = str.maketrans({'T': None, ';': ','})
+
+    def __init__(self, field_kinds, block_size, period, layout=None):
+        '''
+
+        :param field_kinds: names of the field axes of the record
+        :param block_size: number of samples per fetched block
+        :param period: trigger period, used to date each sample of the block from the block timestamp
+        :param layout: FetchLayout of the responses, all field axes, timestamp and temperature if None
+        '''
+        self.layout = layout if layout is not None else FetchLayout()
+        self.field_kinds = [kind for kind in self.layout.field_kinds if kind in field_kinds]  # fetched, in order
+        self.block_size = block_size
+        self.n_values = len(self.field_kinds) * block_size
+
+        kinds = list(field_kinds) + ['Timestamp', 'Temperature']
+        self.record = np.full(block_size, np.nan, dtype=[(kind, np.float64) for kind in kinds])
+
+        # The timestamp returned by the probe is the one of the last sample of the block
+        self.time_offsets = (np.arange(block_size) - (block_size - 1)) * period
+
+        self.status = None
+
+    def parse(self, res, temperature=None):
+        '''
+        Parse a fetch response, laid out as the fetched field axes, the timestamp, the temperature and the status
+        byte, the timestamp and temperature being left out when the layout does not fetch them
+        :param res: response string
+        :param temperature: True if the response holds the temperature, as the layout tells if None
+        :return: the record holding the parsed values
+        '''
+        if temperature is None:
+            temperature = self.layout.temperature_every > 0
+
+        text = res.translate(self.translation)
+
+        fields = np.fromstring(text, dtype=np.float64, count=self.n_values, sep=',')
+        for kind, field in zip(self.field_kinds, fields.reshape(len(self.field_kinds), self.block_size)):
+            self.record[kind] = field
+
+        # text mode of np.fromstring stops after the field values, the other values are split from the end
+        tail = text.rsplit(',', self.layout.timestamp + temperature + 1)[1:]
+        if self.layout.timestamp:
+            np.add(self.time_offsets, int(tail[0], 0) * 1e-9, out=self.record['Timestamp'])
+        if temperature:
+            self.record['Temperature'] = int(tail[-2])
+        self.status = tail[-1].strip()
+
+        return self.record
@@ -0,0 +1,104 @@
+'''
+Latency histograms used to instrument the THM1176 driver
+
+Durations are accumulated per name (SCPI command or acquisition phase) in log spaced bins, so that recording stays
+cheap and memory constant however long the instrumented run is.
+'''
+
+import bisect
+import contextlib
+import time
+import numpy as np
+
+
+class LatencyHistograms:
+
+    def __init__(self, min_latency=1e-6, max_latency=100.0, bins_per_decade=10):
+        '''
+
+        :param min_latency: lower edge of the first bin, in s
+        :param max_latency: upper edge of the last bin, in s
+        :param bins_per_decade: number of bins per decade of duration
+        '''
+        n_bins = int(round(np.log10(max_latency / min_latency) * bins_per_decade))
+        self.edges = np.logspace(np.log10(min_latency), np.log10(max_latency), n_bins + 1).tolist()
+        self.histograms = {}  # name -> counts, with an underflow and an overflow bin
+        self.stats = {}  # name -> [count, total, min, max]
+        self.command_depth = 0
+
+    def record(self, name, duration):
+        if name not in self.histograms:
+            self.histograms[name] = [0] * (len(self.edges) + 1)
+            self.stats[name] = [0, 0.0, duration, duration]
+
+        self.histograms[name][bisect.bisect(self.edges, duration)] += 1
+        stats = self.stats[name]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = min(stats[2], duration)
+        stats[3] = max(stats[3], duration)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time the enclosed code as an occurrence of the phase name
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def command(self, name):
+        '''
+        Time the enclosed code as an occurrence of the command name
+        Commands issued while another one is being timed (e.g. the write of an ask) are not recorded on their own
+        '''
+        self.command_depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.command_depth -= 1
+            if self.command_depth == 0:
+                self.record(name, duration)
+
+    def as_dict(self):
+        '''
+        :return: dict, per name, of the count, total, mean, min and max durations, the bin edges and bin counts.
+        The first and last counts are the underflow and overflow bins.
+        '''
+        res = {}
+        for name, counts in self.histograms.items():
+            count, total, min_duration, max_duration = self.stats[name]
+            res[name] = {'count': count, 'total': total, 'mean': total / count, 'min': min_duration,
+                         'max': max_duration, 'edges': list(self.edges), 'counts': list(counts)}
+
+        return res
+
+    def to_csv(self, filename):
+        '''
+        Write the non empty bins of all histograms, one line per bin
+        :param filename: output file
+        :return:
+        '''
+        edges = [0.0] + self.edges + [float('inf')]
+        with open(filename, 'w') as f:
+            f.write('name,bin_low,bin_high,count\n')
+            for name, counts in self.histograms.items():
+                for idx, count in enumerate(counts):
+                    if count:
+                        f.write('"{}",{},{},{}\n'.format(name, edges[idx], edges[idx + 1], count))
+
+    def summary(self):
+        '''
+        :return: one line per name with count, mean, min and max durations in ms, slowest in total first
+        '''
+        lines = []
+        for name, (count, total, min_duration, max_duration) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<40} n={:<8} total={:10.1f}ms mean={:8.3f}ms min={:8.3f}ms max={:8.3f}ms'.format(
+                name[:40], count, total * 1e3, total / count * 1e3, min_duration * 1e3, max_duration * 1e3))
+
+        return '\n'.join(lines)
@@ -0,0 +1,80 @@
+'''
+Model of the THM1176 clock, mapping probe timestamps onto host monotonic time
+
+The probe dates each block with its own clock (:FETCH:TIMESTAMP?, in ns, the time of the last sample of the block).
+Samples of periodic acquisitions are triggered by the probe timer, driven by the same clock, so their probe times
+are exactly one period apart; samples of bursts follow each other by the acquisition time of one sample.
+The probe clock runs at a slightly different rate than the host clock, and from an unknown origin. The model is
+
+    host_time = offset + rate * probe_time
+
+Each fetch gives an observation: the timestamp of the last sample, and the host time at which the response was
+received, which is later than the sample by the (variable) fetch latency. The rate (drift correction) is fitted by
+least squares over a window of recent observations once they span long enough, refitted every refit_interval
+observations. The offset is the lower envelope of the observations: the one with the smallest latency bounds the
+mapping best. Host times are thus late by the smallest fetch latency observed, typically below a millisecond over USB.
+'''
+
+import numpy as np
+
+
+class ProbeClock:
+
+    refit_interval = 16  # observations between two fits of the rate
+
+    def __init__(self, window=256, min_span=1.0):
+        '''
+
+        :param window: number of recent observations the model is fitted on
+        :param min_span: probe time spanned by the observations before the rate is fitted, in s
+        '''
+        self.probe_times = np.zeros(window)
+        self.host_times = np.zeros(window)
+        self.count = 0  # number of observations since the last reset
+        self.min_span = min_span
+        self.rate = 1.0
+        self.offset = None
+
+    def reset(self):
+        self.count = 0
+        self.rate = 1.0
+        self.offset = None
+
+    def observe(self, probe_time, host_time):
+        '''
+        Refine the model with a timestamp and the time it was received at
+        :param probe_time: probe timestamp, in s
+        :param host_time: host monotonic time at which the timestamp was received, in s
+        :return:
+        '''
+        window = len(self.probe_times)
+        if self.count and probe_time < self.probe_times[(self.count - 1) % window]:
+            # the probe clock restarted (probe reset)
+            self.reset()
+        self.probe_times[self.count % window] = probe_time
+        self.host_times[self.count % window] = host_time
+        self.count += 1
+
+        n = min(self.count, window)
+        probe, host = self.probe_times[:n], self.host_times[:n]
+        if self.count % self.refit_interval == 0 and probe.max() - probe.min() >= self.min_span:
+            self.rate = np.polyfit(probe - probe_time, host - host_time, 1)[0]
+
+        # Each timestamp is received after the sample it dates: the smallest delay is the best bound
+        self.offset = np.min(host - self.rate * probe)
+
+    def to_host(self, probe_times):
+        '''
+        :param probe_times: probe timestamps, in s
+        :return: host monotonic times, in s (NaN before the first observation)
+        '''
+        if self.offset is None:
+            return np.full(np.shape(probe_times), np.nan)
+        return self.offset + self.rate * np.asarray(probe_times, dtype=float)
+
+    @property
+    def drift(self):
+        '''
+        :return: rate difference of the probe clock with respect to the host clock, in ppm
+        '''
+        return (1.0 / self.rate - 1.0) * 1e6
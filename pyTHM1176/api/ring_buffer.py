@@ -0,0 +1,71 @@
+'''
+Fixed capacity, array backed buffer used to store the samples of long periodic THM1176 acquisitions
+
+Appending a block only copies the block into preallocated storage, so the cost does not grow with the length of the
+run and memory stays constant: once the buffer is full, the oldest samples are overwritten.
+Readers get consistent copies of all fields through snapshot, while the acquisition thread keeps appending.
+'''
+
+import threading
+import numpy as np
+
+
+class RingBuffer:
+
+    def __init__(self, fields, capacity, dtype=np.float64):
+        '''
+
+        :param fields: names of the fields stored for each sample
+        :param capacity: maximum number of samples kept
+        :param dtype: data type of the storage
+        '''
+        self.fields = list(fields)
+        self.capacity = int(capacity)
+        self.data = np.empty((len(self.fields), self.capacity), dtype=dtype)
+        self.count = 0  # total number of samples appended since creation or last clear
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, block):
+        '''
+        Append a block of samples
+        :param block: dict of equally sized arrays, one per field
+        :return:
+        '''
+        n_samples = len(block[self.fields[0]])
+        skip = max(n_samples - self.capacity, 0)  # a block larger than the buffer only keeps its last samples
+
+        with self.lock:
+            pos = (self.count + skip) % self.capacity
+            n_kept = n_samples - skip
+            n_first = min(n_kept, self.capacity - pos)
+
+            for row, field in zip(self.data, self.fields):
+                values = block[field][skip:]
+                row[pos:pos + n_first] = values[:n_first]
+                row[:n_kept - n_first] = values[n_first:]
+
+            self.count += n_samples
+
+    def snapshot(self, n_last=None):
+        '''
+        Copy of the buffer content, in acquisition order
+        :param n_last: only return the n_last most recent samples
+        :return: dict of arrays, one per field
+        '''
+        with self.lock:
+            n_samples = len(self)
+            if n_last is not None:
+                n_samples = min(n_samples, n_last)
+
+            end = self.count % self.capacity
+            idx = np.arange(end - n_samples, end) % self.capacity
+            data = self.data[:, idx]
+
+        return {field: row for field, row in zip(self.fields, data)}
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
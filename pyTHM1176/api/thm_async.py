@@ -0,0 +1,122 @@
+'''
+asyncio front-end for the THM1176 driver
+
+All the blocking USB calls of a Thm1176 instance are run in a dedicated single thread executor, so they stay
+serialized while the event loop is free to drive motion, file writing, etc. in the meantime.
+
+Example:
+
+    async def main():
+        async with await AsyncThm1176.open(backend.list_devices()[0], **params) as thm:
+            print(await thm.get_id())
+            reading = await thm.measure(**params)
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+
+
+class AsyncThm1176:
+
+    def __init__(self, thm, executor=None):
+        '''
+
+        :param thm: Thm1176 instance. It should not be used directly anymore, as calls would not be serialized
+        :param executor: executor running the blocking calls, must have a single worker
+        '''
+        self.thm = thm
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1,
+                                                                                 thread_name_prefix='thm1176')
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        '''
+        Create the underlying Thm1176 (which blocks while the device resets) without blocking the event loop
+        :param args: arguments of Thm1176
+        :param kwargs: arguments of Thm1176
+        :return: AsyncThm1176 instance
+        '''
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thm1176')
+        loop = asyncio.get_running_loop()
+        thm = await loop.run_in_executor(executor, functools.partial(thm_api.Thm1176, *args, **kwargs))
+        return cls(thm, executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def run(self, func, *args, **kwargs):
+        '''
+        Run a blocking call in the probe executor
+        :return: result of the call
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get_id(self):
+        return await self.run(self.thm.get_id)
+
+    async def setup(self, **kwargs):
+        await self.run(self.thm.setup, **kwargs)
+
+    async def measure(self, **kwargs):
+        '''
+        Single acquisition, see Thm1176.make_measurement
+        :return: dict of arrays, one per fetch kind
+        '''
+        def measure():
+            self.thm.make_measurement(**kwargs)
+            return self.thm.copy_reading()
+
+        return await self.run(measure)
+
+    async def start(self):
+        '''
+        Start a periodic acquisition, whose blocks are then obtained with fetch_block
+        The sensor should be set up first for periodic acquisition
+        :return:
+        '''
+        def start():
+            self.thm.running = True
+            self.thm.stop = False
+            self.thm.write(':INIT')
+
+        await self.run(start)
+
+    async def fetch_block(self):
+        '''
+        Fetch the next block of the periodic acquisition started by start
+        :return: dict of arrays, one per fetch kind
+        '''
+        return await self.run(self.thm.fetch_block)
+
+    async def stop(self):
+        def stop():
+            self.thm.stop_acquisition()
+            self.thm.running = False
+
+        await self.run(stop)
+
+    async def blocks(self, n_blocks=None):
+        '''
+        Asynchronous iterator over the blocks of a periodic acquisition, stopped when the iteration ends
+        :param n_blocks: number of blocks to acquire, None to run until the iteration is interrupted
+        :return: async generator of blocks
+        '''
+        await self.start()
+        try:
+            count = 0
+            while n_blocks is None or count < n_blocks:
+                yield await self.fetch_block()
+                count += 1
+        finally:
+            await self.stop()
+
+    async def close(self):
+        await self.run(self.thm.close)
+        self.executor.shutdown(wait=True)
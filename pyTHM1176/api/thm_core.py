@@ -0,0 +1,1019 @@
+'''
+Protocol core of Metrolab's THM1176 field probe driver, independent of the transport
+
+Thm1176Core holds the SCPI protocol: configuration, acquisition, fetch command building, parsing and decoding of the
+responses, timing model, error draining, instrumentation. It is used as the first base of the driver classes of each
+backend, thm_usbtmc_api.Thm1176 and thm_visa_api.Thm1176, followed by the transport class, which provides the
+interface of usbtmc.Instrument used by the core: write, read, ask and read_raw, timeout (in s) and
+max_transfer_size attributes, close. The driver class adds:
+    transport_errors: exceptions raised by the transport when the probe does not answer
+    reset_device(): bring the probe back to a known state
+    read_raw_into_buffer(): read a binary response, returned as a bytes-like object that may be reused by the next read
+
+functions
+parse_ieee_block_header
+from_binary_block
+_use_numpy_routines
+are copied from pyVISA library
+copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+license: MIT, see pyVISA LICENSE for more details.
+'''
+
+import re
+import struct
+import inspect
+import time
+import queue
+import threading
+import collections
+import contextlib
+import numpy as np
+
+from pyTHM1176.api.ring_buffer import RingBuffer
+from pyTHM1176.api.fetch_parser import AsciiFetchParser, FetchLayout
+from pyTHM1176.api.latency import LatencyHistograms
+from pyTHM1176.api.probe_clock import ProbeClock
+
+def _use_numpy_routines(container):
+    """Should optimized numpy routines be used to extract the data.
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+    if np is None or container in (tuple, list):
+        return False
+
+    if (container is np.array or (inspect.isclass(container) and
+                                  issubclass(container, np.ndarray))):
+        return True
+
+    return False
+
+
+def parse_ieee_block_header(block):
+    """
+    Parse the header of a IEEE block.
+    Definite Length Arbitrary Block:
+    #<header_length><data_length><data>
+    The header_length specifies the size of the data_length field.
+    And the data_length field specifies the size of the data.
+    Indefinite Length Arbitrary Block:
+    #0<data>
+    :param block: IEEE block.
+    :type block: bytes | bytearray
+    :return: (offset, data_length)
+    :rtype: (int, int)
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+
+    begin = block.find(b'#')
+    if begin < 0:
+        raise ValueError("Could not find hash sign (#) indicating the start of"
+                         " the block.")
+
+    try:
+        # int(block[begin+1]) != int(block[begin+1:begin+2]) in Python 3
+        header_length = int(block[begin + 1:begin + 2])
+    except ValueError:
+        header_length = 0
+    offset = begin + 2 + header_length
+
+    if header_length > 0:
+        # #3100DATA
+        # 012345
+        data_length = int(block[begin + 2:offset])
+    else:
+        # #0DATA
+        # 012
+        data_length = len(block) - offset - 1
+
+    return offset, data_length
+
+
+def from_binary_block(block, offset=0, data_length=None, datatype='f',
+                      is_big_endian=False, container=list):
+    """
+    Convert a binary block into an iterable of numbers.
+    :param block: binary block.
+    :type block: bytes | bytearray
+    :param offset: offset at which the data block starts (default=0)
+    :param data_length: size in bytes of the data block
+                        (default=len(block) - offset)
+    :param datatype: the format string for a single element. See struct module.
+    :param is_big_endian: boolean indicating endianess.
+    :param container: container type to use for the output data.
+    :return: items
+    :rtype: type(container)
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+
+    if data_length is None:
+        data_length = len(block) - offset
+
+    element_length = struct.calcsize(datatype)
+    array_length = int(data_length / element_length)
+
+    endianess = '>' if is_big_endian else '<'
+
+    if _use_numpy_routines(container):
+        return np.frombuffer(block, endianess + datatype, array_length, offset)
+
+    fullfmt = '%s%d%s' % (endianess, array_length, datatype)
+
+    try:
+        return container(struct.unpack_from(fullfmt, block, offset))
+    except struct.error:
+        raise ValueError("Binary data was malformed")
+
+
+def decode_binary_fetch(block, n_fields, datatype='>i4'):
+    """
+    Decode a fetch response made of n_fields binary fields followed by ';' separated ascii fields.
+    Each binary field is either an IEEE definite length block (array fetch) or, for scalar fetches,
+    a plain ascii integer. Arrays are numpy views on the response buffer: no data is copied.
+    :param block: raw response of the probe
+    :type block: bytes | bytearray | memoryview
+    :param n_fields: number of binary fields at the start of the response
+    :param datatype: numpy dtype of a single element
+    :return: (list of arrays, list of the remaining ascii fields)
+    :rtype: (list, list)
+    """
+    arrays = []
+    pos = 0
+    for _ in range(n_fields):
+        # Separators are searched in short copies around the ascii parts only, block may be a memoryview
+        if block[pos:pos + 1] == b'#':
+            offset, length = parse_ieee_block_header(bytes(block[pos:pos + 12]))
+            start = pos + offset
+            arrays.append(np.frombuffer(block, datatype, length // np.dtype(datatype).itemsize, start))
+            # skip to the separator following the data, which may itself contain ';' bytes
+            end = bytes(block[start + length:start + length + 16]).find(b';')
+            pos = start + length + end + 1 if end >= 0 else 0
+        else:
+            end = bytes(block[pos:pos + 32]).find(b';')
+            arrays.append(np.array([int(bytes(block[pos:pos + end]))], dtype=datatype))
+            pos = pos + end + 1 if end >= 0 else 0
+
+        if pos == 0:
+            raise ValueError("Binary data was malformed")
+
+    return arrays, bytes(block[pos:]).rstrip(b'\r\n').split(b';')
+
+
+class Thm1176Core:
+    ranges = ["0.1T", '0.3T', '1T', '3T']
+    full_scales = {'0.1T': 0.1, '0.3T': 0.3, '1T': 1.0, '3T': 3.0}  # largest field of each range, in T
+    trigger_period_bounds = (122e-6, 2.79)
+    base_fetch_cmd = {"periodic": ':FETCh:ARRay:', "single": ":FETCh:SCALar:", "burst": ':FETCh:ARRay:'}
+    axes = ['X', 'Y', 'Z']
+    field_axes = ['Bx', 'By', 'Bz']
+    fetch_kinds = ['Bx', 'By', 'Bz', 'Timestamp',
+                   'Temperature']  # Order matters, this is linked to the fetch command that is sent to retrived data
+    reading_kinds = fetch_kinds + ['HostTime']  # HostTime: Timestamp mapped onto host monotonic time by the clock model
+    n_digits = 5
+    max_block_size = 4096  # largest number of samples fetched in one block
+    # INTEGER readings are raw probe counts, not T: ASCII by default, INTEGER for raw high rate acquisitions
+    defaults = {'block_size': 10, 'period': 0.5, 'range': '0.1T', 'average': 1, 'format': 'ASCII',
+                'wait_mode': 'opc', 'buffer_size': 600000, 'reset': 'auto', 'fetch_axes': 'XYZ',
+                'fetch_timestamp': True, 'temperature_every': 1}
+    id_fields = ['manufacturer', 'model', 'serial', 'version']
+    # How make_measurement waits for the end of the acquisition:
+    # 'sleep' fixed delay, 'opc' blocking *OPC? query, 'poll' *OPC flag polled through *ESR?
+    wait_modes = ['sleep', 'opc', 'poll']
+    fixed_wait = 0.1  # delay used by the 'sleep' wait mode, in s
+    poll_interval = 1e-3  # delay between two *ESR? queries in 'poll' wait mode, in s
+    timing_memory = 0.9  # forgetting factor of the acquisition duration fit (1.0: never forget)
+    error_available_bit = 4  # status byte bit set while the error queue is not empty
+    error_batch = 8  # number of :SYSTEM:ERROR? queries sent in a single transaction when draining errors
+    max_errors = 1000  # number of errors kept in the error log
+    error_pattern = re.compile(r'([+-]?\d+),"([^"]*)"')
+    attach_timeout = 0.5  # timeout of the responsiveness check done when attaching to the probe, in s
+    transport_errors = (UnicodeDecodeError,)  # completed by each backend
+    untimed = contextlib.nullcontext()  # stands for the timers while instrumentation is disabled
+
+    def __init__(self, *args, **kwargs):
+        '''
+
+        :param args: passed to the transport class, see the backends
+        :param kwargs: setup parameters, plus 'reset': True to always reset the device, False to never reset it,
+        'auto' (default) to only reset it if it does not answer a quick identification query
+        '''
+        self.instrumentation = None  # LatencyHistograms, when enabled
+        super().__init__(*args, **kwargs)
+
+        self.running = False
+        self.stop = False
+
+        self.fetch_cmd = None
+        self.fetch_cmd_no_temperature = None  # used by the fetches that skip the temperature
+        self.fetch_cmds = {}  # fetch command strings already built, keyed by (trigger_type, block_size, layout)
+        self.fetch_layout = FetchLayout(self.defaults['fetch_axes'], self.defaults['fetch_timestamp'],
+                                        self.defaults['temperature_every'])
+        self.fetch_count = 0  # number of fetches done, to fetch the temperature every temperature_every ones
+        self.applied_config = {}  # last value sent for each configuration command header
+        self.ascii_parser = None
+        self.ascii_parsers = {}  # ascii fetch parsers already compiled, keyed by (block_size, period, layout)
+
+        self.max_transfer_size = 49216  # (4096 samples * 3 axes * 4B/sample + 64B for time&temp&...
+        self.timeout = 10
+
+        self.block_size = self.defaults['block_size']
+        self.period = self.defaults['period']
+        self.range = self.defaults['range']
+        self.average = self.defaults['average']
+        self.format = self.defaults['format']
+        self.wait_mode = self.defaults['wait_mode']
+
+        # Acquisition duration model: overhead + average * time_per_average (in s)
+        # Starting values are rough guesses, refined from the completion times observed in make_measurement
+        self.acq_overhead = 5e-3
+        self.acq_time_per_average = 40e-6
+        self.timing_sums = np.zeros(5)  # weighted n, sum(avg), sum(t), sum(avg^2), sum(avg*t)
+
+        self.trigger_type = None
+        self.clock = ProbeClock()  # maps the probe timestamps onto host monotonic time
+        self.last_reading = {kind: None for kind in self.reading_kinds}
+        self.last_uncertainty = None  # standard error of each field axis of the last adaptive measurement
+        # Samples of periodic acquisitions. Oldest samples are dropped once buffer_size is reached
+        self.acquisition_buffer = RingBuffer(self.reading_kinds, self.defaults['buffer_size'])
+        self.errors = collections.deque(maxlen=self.max_errors)  # (time, code, message) of the errors drained
+        self.error_handler = None  # called with each (time, code, message) instead of printing it
+        self.error_reports = queue.Queue()  # errors waiting to be reported by the reporting thread
+        self.error_reporter = None
+
+        reset = kwargs.get('reset', self.defaults['reset'])
+        if reset is True or (reset == 'auto' and not self.attach()):
+            self.reset_device()
+
+        self.setup(**kwargs)
+
+    def is_responsive(self):
+        '''
+        Check that the probe answers an identification query correctly and quickly
+        :return: True if it does
+        '''
+        timeout = self.timeout
+        self.timeout = self.attach_timeout
+        try:
+            return self.ask('*IDN?').startswith('Metrolab')
+        except self.transport_errors:
+            return False
+        finally:
+            self.timeout = timeout
+
+    def attach(self):
+        '''
+        Warm attach to a probe left in an unknown state by a previous session: stop any running acquisition and clear
+        the status, without resetting the device
+        :return: True if the probe is responsive, False if it needs a reset
+        '''
+        if not self.is_responsive():
+            return False
+
+        self.write(':ABORT;*CLS')
+        self.invalidate_config()
+        return True
+
+    def enable_instrumentation(self, **kwargs):
+        '''
+        Start recording latency histograms per SCPI command and per phase (configure, init, fetch, parse)
+        :param kwargs: bins definition, see LatencyHistograms
+        :return: the LatencyHistograms instance, exposing the histograms with as_dict and to_csv
+        '''
+        self.instrumentation = LatencyHistograms(**kwargs)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        '''
+        Stop recording latencies
+        :return: the LatencyHistograms recorded so far, or None
+        '''
+        instrumentation, self.instrumentation = self.instrumentation, None
+        return instrumentation
+
+    def phase(self, name):
+        '''
+        :return: context manager timing the enclosed code as phase name, when instrumentation is enabled
+        '''
+        if self.instrumentation is None:
+            return self.untimed
+        return self.instrumentation.phase(name)
+
+    def command(self, message):
+        '''
+        :return: context manager timing the enclosed code as the command message, when instrumentation is enabled
+        '''
+        if self.instrumentation is None:
+            return self.untimed
+        headers = ';'.join(cmd.strip().split(' ')[0] for cmd in message.split(';'))
+        return self.instrumentation.command(headers)
+
+    def write_setting(self, header, value):
+        '''
+        Send a configuration command, unless the same value was the last one applied for that header.
+        :param header: SCPI command header, e.g. ':AVERAGE:COUNT'
+        :param value: argument of the command
+        :return: True if the command was sent to the probe
+        '''
+        value = str(value)
+        if self.applied_config.get(header) == value:
+            return False
+
+        self.write(header + ' ' + value)
+        self.applied_config[header] = value
+        return True
+
+    def invalidate_config(self):
+        '''
+        Forget the configuration tracked as applied, so that the next setup resends every setting.
+        To be called whenever the probe state may have changed behind our back (reset, *RST, other client...)
+        :return:
+        '''
+        self.applied_config = {}
+
+    @property
+    def data_stack(self):
+        '''
+        Samples accumulated by start_acquisition, in acquisition order
+        Each access returns a consistent copy, take it once and index it rather than accessing it for each kind
+        :return: dict of arrays, one per fetch kind
+        '''
+        return self.acquisition_buffer.snapshot()
+
+    def set_format(self):
+        self.write_setting(':FORMAT:DATA', self.format)
+
+    def set_average(self):
+
+        self.write_setting(':AVERAGE:COUNT', self.average)
+
+    def set_range(self):
+        '''
+        Set sense range of the Metrolab THM1176
+        Possible ranges are 0.1T,0.3T,1T,3T
+        :param range_str:
+        :return:
+        '''
+
+        self.write_setting(':SENSe:FLUX:RANGe', self.range)
+
+    def set_trigger(self, trigger_type):
+        '''
+        Set the probe to run in periodic trigger mode with a given period, continuously
+        :param period:
+        :return:
+        '''
+
+        if trigger_type == "periodic":
+            if self.trigger_period_bounds[0] <= self.period <= self.trigger_period_bounds[1]:
+                self.write_setting(':TRIGger:SOURce', 'TIMer')
+                self.write_setting(':TRIGger:TIMer', '{:f}S'.format(self.period))
+                self.write_setting(':TRIG:COUNT', self.block_size)
+                self.write_setting(':INIT:CONTINUOUS', 'ON')
+                return True
+            else:
+                print('Invalid trigger period value.')
+                return False
+        elif trigger_type == "single":
+            self.write_setting(':TRIG:COUNT', 1)
+            self.write_setting(':TRIGger:SOURce', 'IMMediate')
+            # left ON by a periodic acquisition, it would restart the acquisition after each one
+            self.write_setting(':INIT:CONTINUOUS', 'OFF')
+            return True
+        elif trigger_type == "burst":
+            self.write_setting(':TRIG:COUNT', self.block_size)
+            self.write_setting(':TRIGger:SOURce', 'IMMediate')
+            self.write_setting(':INIT:CONTINUOUS', 'OFF')
+            return True
+        else:
+            return False
+
+    def str_conv(self, input_str, kind):
+        if kind == 'Timestamp':
+            val = int(input_str, 0) * 1e-9
+            time_offset = val - (self.block_size - 1) * self.sample_spacing()
+            res = np.linspace(time_offset, val, self.block_size)
+        elif kind == 'Temperature':
+            res = int(input_str) * np.ones(self.block_size)
+
+        else:
+            res = np.fromstring(input_str.replace('T', ''), sep=',')
+
+        return res
+
+    def parse_ascii_responses(self, kind, res_in, temperature=True):
+        '''
+
+        :param kind:
+        :param temperature: True if the response holds the temperature
+        :return:
+        '''
+        if kind == 'fetch':
+            record = self.ascii_parser.parse(res_in, temperature)
+
+            for key in self.fetch_kinds:
+                self.last_reading[key] = record[key]
+
+            if self.trigger_type == 'burst' and self.fetch_layout.timestamp:
+                # The parser dates samples one trigger period apart, burst samples follow each other
+                timestamps = record['Timestamp']
+                timestamps[:] = timestamps[-1] + (np.arange(self.block_size) - (self.block_size - 1)) * \
+                    self.sample_spacing()
+
+            if int(self.ascii_parser.status) & self.error_available_bit:
+                self.drain_errors()
+
+    def parse_binary_responses(self, kind, res_in, temperature=True):
+
+        if kind == 'fetch':
+            layout = self.fetch_layout
+            arrays, parsed = decode_binary_fetch(res_in, len(layout.axes))
+            for key in self.field_axes:
+                self.last_reading[key] = np.full(self.block_size, np.nan)
+            for key, values in zip(layout.field_kinds, arrays):
+                self.last_reading[key] = values
+
+            if layout.timestamp:
+                self.last_reading['Timestamp'] = self.str_conv(parsed[0].decode('ascii'), 'Timestamp')
+            else:
+                self.last_reading['Timestamp'] = np.full(self.block_size, np.nan)
+
+            if temperature:
+                self.last_reading['Temperature'] = self.str_conv(parsed[-2].decode('ascii'), 'Temperature')
+            else:
+                # Keep the last temperature fetched
+                last = self.last_reading['Temperature']
+                self.last_reading['Temperature'] = np.full(self.block_size, last[-1] if last is not None else np.nan)
+
+            if int(parsed[-1]) & self.error_available_bit:
+                self.drain_errors()
+
+    def sample_spacing(self):
+        '''
+        Probe time between two samples of a block: the trigger period for periodic acquisitions, the (estimated)
+        acquisition time of one sample for bursts
+        :return: in s
+        '''
+        if self.trigger_type == 'periodic':
+            return self.period
+        return self.average * self.acq_time_per_average
+
+    def date_reading(self, received):
+        '''
+        Map the timestamps of the last reading onto host time, refining the clock model with the block timestamp
+        :param received: host monotonic time at which the response was received
+        :return:
+        '''
+        timestamps = self.last_reading['Timestamp']
+        if not self.fetch_layout.timestamp:
+            self.last_reading['HostTime'] = np.full(self.block_size, np.nan)
+            return
+
+        self.clock.observe(timestamps[-1], received)
+        self.last_reading['HostTime'] = self.clock.to_host(timestamps)
+
+    def get_id(self):
+        '''
+        Get the identification string of the instrument.
+        Parse it according to expected format specified by docs.
+        :return:
+        '''
+        self.write('*IDN?')
+        res = self.read()
+        id_vals = res.split(',')
+        header = {field: val for field, val in zip(self.id_fields, id_vals)}
+
+        return header
+
+    def get_data_array(self):
+        '''
+        Fetch data from probe buffer
+        :return:
+        '''
+        if self.running:
+            self.fetch_reading()
+
+    def fetch_reading(self):
+        '''
+        Fetch the data of the last acquisition and parse it into last_reading
+        :return:
+        '''
+        temperature = self.fetch_layout.has_temperature(self.fetch_count)
+        fetch_cmd = self.fetch_cmd if temperature else self.fetch_cmd_no_temperature
+        self.fetch_count += 1
+
+        if self.format == 'ASCII':
+            with self.phase('fetch'):
+                res = self.ask(fetch_cmd)
+                received = time.monotonic()
+            with self.phase('parse'):
+                self.parse_ascii_responses('fetch', res, temperature)
+                self.date_reading(received)
+
+        elif self.format == 'INTEGER':
+            with self.phase('fetch'):
+                self.write(fetch_cmd)
+                res = self.read_raw_into_buffer()
+                received = time.monotonic()
+            with self.phase('parse'):
+                self.parse_binary_responses('fetch', res, temperature)
+                self.date_reading(received)
+
+    def setup(self, **kwargs):
+        '''
+
+        :param kwargs:
+        :return:
+        '''
+        keys = list(kwargs.keys())
+        trigger_type = kwargs["trigger_type"]
+
+        if trigger_type == "periodic":
+            # This will setup the sensor to acquire continuously with a set time period
+            # Acquisition will be started with the "INITiate" command and data should be fetched on time with "FETCh:ARRay"
+            if 'block_size' in keys:
+                self.block_size = kwargs['block_size']
+
+            if 'period' in keys:
+                if self.trigger_period_bounds[0] <= kwargs['period'] <= self.trigger_period_bounds[1]:
+                    self.period = kwargs['period']
+                else:
+                    print('Invalid trigger period value.')
+                    print('Setting to default...')
+                    self.period = self.defaults['period']
+
+            self.set_trigger("periodic")
+
+        elif trigger_type == "single":
+            # This will setup the sensor to acquire a single trigger
+            # Acquisition should be started by "READ" and data obtained via FETCH
+            self.set_trigger("single")
+            self.block_size = 1 # needed for data unpacking
+
+        elif trigger_type == "burst":
+            # This will setup the sensor to acquire block_size triggers back to back, each with the set averaging
+            # Acquisition is started like a single one, and all the samples are obtained with a single FETCh:ARRay
+            if 'block_size' in keys:
+                self.block_size = kwargs['block_size']
+
+            self.set_trigger("burst")
+
+        else:
+            print("Invalid trigger type! Nothing setup.")
+            return
+        self.trigger_type = trigger_type
+
+        if 'range' in keys:
+            if kwargs['range'] in self.ranges:
+                self.range = kwargs['range']
+
+        if 'average' in keys:
+            self.average = kwargs['average']
+
+        if 'format' in keys:
+            self.format = kwargs['format']
+
+        if 'wait_mode' in keys:
+            if kwargs['wait_mode'] in self.wait_modes:
+                self.wait_mode = kwargs['wait_mode']
+            else:
+                print('Invalid wait mode.')
+
+        if 'fetch_axes' in keys or 'fetch_timestamp' in keys or 'temperature_every' in keys:
+            layout = FetchLayout(kwargs.get('fetch_axes', ''.join(self.fetch_layout.axes)),
+                                 kwargs.get('fetch_timestamp', self.fetch_layout.timestamp),
+                                 kwargs.get('temperature_every', self.fetch_layout.temperature_every))
+            if layout.key != self.fetch_layout.key:
+                self.fetch_layout = layout
+                self.fetch_count = 0
+
+        if 'buffer_size' in keys and kwargs['buffer_size'] != self.acquisition_buffer.capacity:
+            self.acquisition_buffer = RingBuffer(self.reading_kinds, kwargs['buffer_size'])
+
+        self.set_format()
+        self.set_range()
+        self.set_average()
+
+        self.fetch_cmd = self.build_fetch_cmd(trigger_type)
+        self.fetch_cmd_no_temperature = self.build_fetch_cmd(trigger_type, temperature=False)
+        self.ascii_parser = self.build_ascii_parser()
+        if self.last_reading['Temperature'] is not None and self.fetch_layout.temperature_every != 1:
+            # Fetches that skip the temperature keep the last one fetched, whichever parser read it
+            self.ascii_parser.record['Temperature'] = self.last_reading['Temperature'][-1]
+
+    def build_ascii_parser(self):
+        '''
+        Get the parser of ascii fetch responses for the current block size, period and fetch layout, compiling it if
+        needed
+        :return: AsciiFetchParser instance
+        '''
+        layout = (self.block_size, self.period, self.fetch_layout.key)
+        if layout not in self.ascii_parsers:
+            self.ascii_parsers[layout] = AsciiFetchParser(self.field_axes, self.block_size, self.period,
+                                                          self.fetch_layout)
+
+        return self.ascii_parsers[layout]
+
+    def build_fetch_cmd(self, trigger_type, temperature=True):
+        '''
+        Build the command string used to fetch data for the given trigger type, current block size and fetch layout.
+        Command strings are cached, as they only depend on the fetch layout.
+        :param trigger_type: "periodic", "single" or "burst"
+        :param temperature: fetch the temperature, if the fetch layout ever does
+        :return: fetch command string
+        '''
+        temperature = temperature and self.fetch_layout.temperature_every > 0
+        layout = (trigger_type, self.block_size, self.fetch_layout.key, temperature)
+        if layout in self.fetch_cmds:
+            return self.fetch_cmds[layout]
+
+        cmd = ''
+        for axis in self.fetch_layout.axes:
+            if trigger_type == "single":
+                cmd += self.base_fetch_cmd["single"] + axis + '? {};'.format(self.n_digits)
+            else:
+                cmd += self.base_fetch_cmd[trigger_type] + axis + '? {},{};'.format(self.block_size, self.n_digits)
+
+        if self.fetch_layout.timestamp:
+            cmd += ':FETCH:TIMESTAMP?;'
+        if temperature:
+            cmd += ':FETCH:TEMPERATURE?;'
+        cmd += '*STB?'
+        self.fetch_cmds[layout] = cmd
+
+        return cmd
+
+    def make_measurement(self, **kwargs):
+        """
+        To be used for single, one-off acquisition with parameters supplied (may have averaging)
+        Only the settings that differ from the last applied configuration are sent to the probe
+        :return:
+        """
+        with self.phase('configure'):
+            self.setup(**kwargs)
+        with self.phase('init'):
+            self.wait_for_acquisition(self.average, self.block_size)
+        self.fetch_reading()
+
+    def make_burst_measurement(self, n_samples, **kwargs):
+        '''
+        Acquire n_samples measurements back to back (each with the averaging supplied) and fetch them all at once.
+        Replaces n_samples calls to make_measurement when repeating measurements at one position.
+        :param n_samples: number of measurements
+        :param kwargs: setup parameters, as for make_measurement
+        :return: dict with, for each field axis, the 'mean', 'std' and raw 'samples' of the measurements
+        '''
+        kwargs = dict(kwargs, trigger_type="burst", block_size=n_samples)
+        self.make_measurement(**kwargs)
+
+        return self.reading_statistics()
+
+    def make_adaptive_measurement(self, target_std_error, pilot_samples=10, pilot_average=100, max_average=None,
+                                  **kwargs):
+        '''
+        Measure with just the averaging needed to reach a target standard error.
+        A short burst of pilot_samples samples (each averaging pilot_average measurements) gives an estimate of the
+        noise, from which the number of samples needed for the target is derived; more samples are acquired in bursts
+        until every field axis reaches the target, or the total averaging reaches max_average.
+        The mean of the samples is left in last_reading, as for a single measurement, and the achieved standard
+        errors in last_uncertainty.
+        Assumes the noise is white over the duration of the measurement, as the averaging of the probe does.
+        :param target_std_error: target standard error of each field axis, in T
+        :param pilot_samples: number of samples of the noise estimate, fewer if max_average allows fewer
+        :param pilot_average: averaging of each sample
+        :param max_average: upper bound of the total averaging (number of samples * pilot_average), the 'average'
+        setup parameter if None. The measurement is never longer than a single one with this averaging, which must
+        allow the 2 samples of a noise estimate (at least 2 * pilot_average).
+        :param kwargs: setup parameters, as for make_measurement
+        :return: dict with, for each field axis, the 'mean', the achieved 'std_error' and the 'average' used
+        '''
+        self.require_tesla('Adaptive averaging', kwargs)
+        if max_average is None:
+            max_average = kwargs.get('average', self.average)
+        max_samples = max_average // pilot_average
+        if max_samples < 2:
+            raise ValueError('Adaptive averaging needs max_average of at least 2 * pilot_average ({}), not {}'.format(
+                2 * pilot_average, max_average))
+
+        samples = {key: [] for key in self.field_axes}
+        n_samples = 0
+        n_burst = min(pilot_samples, max_samples)
+        while True:
+            stats = self.make_burst_measurement(n_burst, **dict(kwargs, average=pilot_average))
+            for key in self.field_axes:
+                samples[key].append(stats[key]['samples'])
+            n_samples += n_burst
+
+            std_errors = {key: np.concatenate(samples[key]).std(ddof=1) / np.sqrt(n_samples)
+                          for key in self.field_axes}
+            worst = max(std_errors.values())
+            if worst <= target_std_error or n_samples >= max_samples:
+                break
+
+            # Standard error decreases as 1/sqrt(n): samples still needed for the worst axis
+            n_needed = int(np.ceil(n_samples * (worst / target_std_error) ** 2)) - n_samples
+            n_burst = min(max(n_needed, 1), max_samples - n_samples, self.max_block_size)
+
+        result = {}
+        for key in self.field_axes:
+            mean = np.concatenate(samples[key]).mean()
+            self.last_reading[key] = np.array([mean])
+            result[key] = {'mean': mean, 'std_error': std_errors[key], 'average': n_samples * pilot_average}
+        for key in ['Timestamp', 'Temperature', 'HostTime']:
+            self.last_reading[key] = np.array(self.last_reading[key][-1:])
+        self.last_uncertainty = std_errors
+
+        return result
+
+    def require_tesla(self, mode, kwargs=None):
+        '''
+        Refuse the INTEGER format for a mode comparing the readings with field values in T
+        :param mode: name of the mode, for the error message
+        :param kwargs: setup parameters about to be applied, if any
+        :return:
+        '''
+        data_format = (kwargs or {}).get('format', self.format)
+        if data_format != 'ASCII':
+            raise ValueError('{} needs readings in T: use the ASCII format, {} readings are raw probe counts'.format(
+                mode, data_format))
+
+    def make_block_measurement(self, block_size, period, **kwargs):
+        '''
+        Measure by averaging on the host a block of block_size samples acquired every period, instead of averaging
+        on the probe. Besides the mean, this gives the spread of the field and its drift during the measurement.
+        The averaging setup parameter applies to each sample, and should fit in the period.
+        :param block_size: number of samples
+        :param period: trigger period, in s
+        :param kwargs: setup parameters, as for make_measurement
+        :return: dict with, for each field axis, the 'mean', 'std', 'min', 'max', raw 'samples', and the drift 'slope'
+        in T/s of the block
+        '''
+        self.require_tesla('Block measurement', kwargs)
+        kwargs = dict(kwargs, trigger_type="periodic", block_size=block_size, period=period)
+        with self.phase('configure'):
+            self.setup(**kwargs)
+
+        # The array fetch answers once the block is acquired, make sure the read does not time out before that
+        timeout = self.timeout
+        self.timeout = max(timeout, 2 * block_size * self.period + 1)
+        self.running = True
+        try:
+            with self.phase('init'):
+                self.write(':INIT')
+            self.fetch_reading()
+        finally:
+            self.write(':ABORT')
+            self.running = False
+            self.timeout = timeout
+
+        stats = self.reading_statistics()
+        times = np.array(self.last_reading['Timestamp'], dtype=float)
+        if not np.all(np.isfinite(times)):
+            # timestamps not fetched: samples are one period apart
+            times = period * np.arange(len(times))
+        for key in self.field_axes:
+            samples = stats[key]['samples']
+            stats[key]['slope'] = np.polyfit(times - times.mean(), samples, 1)[0] if len(samples) > 1 else 0.0
+
+        return stats
+
+    def reading_statistics(self):
+        '''
+        Statistics of the field samples of the last reading
+        :return: dict with, for each field axis, the 'mean', 'std', 'min', 'max' and raw 'samples' of the reading
+        '''
+        stats = {}
+        for key in self.field_axes:
+            samples = np.array(self.last_reading[key], dtype=float)
+            stats[key] = {'mean': samples.mean(),
+                          'std': samples.std(ddof=1) if len(samples) > 1 else 0.0,
+                          'min': samples.min(),
+                          'max': samples.max(),
+                          'samples': samples}
+
+        return stats
+
+    def predict_acquisition_time(self, average, count=1):
+        '''
+        Predicted duration of an acquisition, from the linear model fitted on previous acquisitions
+        :param average: averaging count of each measurement
+        :param count: number of triggers in the acquisition
+        :return: duration in s
+        '''
+        return self.acq_overhead + count * average * self.acq_time_per_average
+
+    def update_timing_model(self, n_averages, elapsed):
+        '''
+        Refine the acquisition duration model with an observed completion time.
+        This is a weighted least squares fit of elapsed = overhead + n_averages * time_per_average,
+        with older observations progressively forgotten.
+        :param n_averages: total number of averaged samples acquired (average * trigger count)
+        :param elapsed: time between :INIT and completion, in s
+        :return:
+        '''
+        self.timing_sums *= self.timing_memory
+        self.timing_sums += [1.0, n_averages, elapsed, n_averages ** 2, n_averages * elapsed]
+        n, s_a, s_t, s_aa, s_at = self.timing_sums
+
+        det = n * s_aa - s_a ** 2
+        if det > 1e-9 * n * s_aa:
+            slope = (n * s_at - s_a * s_t) / det
+            if slope > 0:
+                self.acq_time_per_average = slope
+                self.acq_overhead = max((s_t - slope * s_a) / n, 0.0)
+                return
+
+        # Not enough spread in averaging counts yet: only adjust the per-average time
+        if n_averages > 0:
+            self.acq_time_per_average = max(elapsed - self.acq_overhead, 0.0) / n_averages
+
+    def wait_for_acquisition(self, average, count=1):
+        '''
+        Start an acquisition and wait for it to complete, according to the selected wait mode.
+        :param average: averaging count of each measurement, used to predict the duration
+        :param count: number of triggers in the acquisition
+        :return: time elapsed between :INIT and completion, in s
+        '''
+        predicted = self.predict_acquisition_time(average, count)
+        start = time.perf_counter()
+
+        if self.wait_mode == 'opc':
+            # *OPC? only answers once the acquisition is over, make sure the read does not time out before that
+            timeout = self.timeout
+            self.timeout = max(timeout, 2 * predicted + 1)
+            try:
+                self.ask(':INIT;*OPC?')
+            finally:
+                self.timeout = timeout
+
+        elif self.wait_mode == 'poll':
+            # *OPC sets the OPC bit of the event status register once the acquisition is over
+            self.write(':INIT;*OPC')
+            deadline = start + 2 * predicted + self.timeout
+            remaining = predicted - (time.perf_counter() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+            while not int(self.ask('*ESR?')) & 1:
+                if time.perf_counter() > deadline:
+                    raise TimeoutError('THM1176 acquisition did not complete')
+                time.sleep(self.poll_interval)
+
+        else:
+            self.write(':INIT')
+            time.sleep(self.fixed_wait)
+            return time.perf_counter() - start
+
+        elapsed = time.perf_counter() - start
+        self.update_timing_model(average * count, elapsed)
+
+        return elapsed
+
+    def start_acquisition(self):
+        """
+        starts a data acquisition
+        To be used for continuous periodic measurements only
+        The sensor should be set up first, using the setup method
+        :return:
+        """
+        self.running = True
+        self.stop = False
+        self.write(':INIT')
+        while not self.stop:
+            self.get_data_array()
+            self.acquisition_buffer.append(self.last_reading)
+
+        self.stop_acquisition()
+        self.running = False
+
+    def fetch_block(self):
+        '''
+        Fetch the next block of a running periodic acquisition
+        :return: dict of arrays, one per fetch kind
+        '''
+        self.get_data_array()
+        return self.copy_reading()
+
+    def copy_reading(self):
+        '''
+        Copy of the last reading. The arrays of last_reading may be reused by the next fetch
+        :return: dict of arrays, one per fetch kind
+        '''
+        return {key: np.array(values) for key, values in self.last_reading.items()}
+
+    def iter_blocks(self, n_blocks=None, queue_size=4):
+        '''
+        Run a periodic acquisition and yield its blocks as they are fetched, as dicts of arrays (one per fetch kind).
+        Blocks are fetched by a background thread and handed over through a queue holding at most queue_size
+        blocks: when the consumer falls behind, fetching waits for room in the queue (the probe keeps acquiring in
+        its own buffer meanwhile).
+        The acquisition is stopped after n_blocks blocks, or when the iterator is closed or garbage collected.
+        The sensor should be set up first for periodic acquisition, using the setup method
+        :param n_blocks: number of blocks to acquire, None to run until the iterator is closed
+        :param queue_size: maximum number of fetched blocks waiting for the consumer
+        :return: generator of blocks
+        '''
+        blocks = queue.Queue(maxsize=queue_size)
+        done = object()
+
+        def put(item):
+            while not self.stop:
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                count = 0
+                while not self.stop and (n_blocks is None or count < n_blocks):
+                    put(self.fetch_block())
+                    count += 1
+            except Exception as exc:
+                put(exc)
+            put(done)
+
+        self.running = True
+        self.stop = False
+        self.write(':INIT')
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                block = blocks.get()
+                if block is done:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+        finally:
+            self.stop = True
+            producer.join()
+            self.stop_acquisition()
+            self.running = False
+
+    def stop_acquisition(self):
+        """
+        To be used for continuous periodic measurements
+        This is the method to stop a continuous acquisition that was started by the start_acquisition method
+        :return:
+        """
+        res = self.ask(':ABORT;*STB?')
+        print("Stopping acquisition...")
+        print("THM1176 status: {}".format(res))
+
+    def check_error(self):
+        '''
+        Read out the error queue of the probe
+        :return: list of (time, code, message) of the errors found
+        '''
+        return self.drain_errors()
+
+    def drain_errors(self):
+        '''
+        Empty the error queue of the probe, reading error_batch errors per transaction until the status byte reports
+        an empty queue. Errors are timestamped, kept in self.errors and reported by a background thread, so the
+        measurement loop is not slowed down by console output.
+        :return: list of (time, code, message) of the errors drained
+        '''
+        query = ';'.join([':SYSTEM:ERROR?'] * self.error_batch) + ';*STB?'
+        drained = []
+
+        for _ in range(self.max_errors // self.error_batch):
+            res = self.ask(query)
+            now = time.time()
+
+            for code, message in self.error_pattern.findall(res):
+                if int(code) != 0:
+                    drained.append((now, int(code), message))
+
+            if not int(res.rsplit(';', 1)[-1]) & self.error_available_bit:
+                break
+
+        for error in drained:
+            self.errors.append(error)
+            self.error_reports.put(error)
+
+        if drained and self.error_reporter is None:
+            self.error_reporter = threading.Thread(target=self.report_errors, daemon=True)
+            self.error_reporter.start()
+
+        return drained
+
+    def report_errors(self):
+        '''
+        Report the drained errors as they come, with error_handler if set, printing them otherwise
+        Runs in a background thread started by drain_errors
+        :return:
+        '''
+        while True:
+            error = self.error_reports.get()
+            if self.error_handler is not None:
+                self.error_handler(error)
+            else:
+                print("Error code: {},\"{}\" at {}".format(error[1], error[2], time.ctime(error[0])))
@@ -0,0 +1,436 @@
+'''
+Software emulation of Metrolab's THM1176 field probe
+
+Thm1176Emulator implements the usbtmc Instrument interface (write_raw, and emulated USB bulk endpoints read by
+usbtmc's read_raw; through them write, read and ask) and answers the subset of SCPI commands used by Thm1176:
+configuration, :INIT/:ABORT, scalar and array fetches in ASCII and INTEGER format, timestamp and temperature, *IDN?,
+*STB?, *OPC?, *OPC/*ESR? and :SYSTEM:ERROR?.
+Acquisitions take the time the averaging and trigger settings imply, the transport adds a configurable latency,
+and field values come from a pluggable field model with gaussian noise. For throughput benchmarks, responses can be
+served as soon as asked instead of when the acquisition would be over (realtime=False). This allows running and
+benchmarking the driver and the scan loops without a probe:
+
+    thm = EmulatedThm1176(latency=1e-3, noise=1e-6, field_model=uniform_field(0, 0, 0.05), **params)
+
+EmulatedVisaResource stands for an opened pyvisa resource, to run the VISA backend the same way:
+
+    thm = thm_visa_api.Thm1176(EmulatedVisaResource(latency=1e-3), **params)
+'''
+
+import re
+import time
+import array
+import struct
+import collections
+import numpy as np
+import usb.core
+import usbtmc
+
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+
+
+def wait_for_response(response_ready, timeout, latency):
+    '''
+    Wait until the response is available, plus the transport latency
+    :param response_ready: time at which the response is available (time.monotonic)
+    :param timeout: in s
+    :param latency: in s
+    :return: False if the response is not available within the timeout, after waiting for the timeout
+    '''
+    wait = response_ready - time.monotonic()
+    if wait > timeout:
+        time.sleep(timeout)
+        return False
+    time.sleep(max(wait, 0.0) + latency)
+    return True
+
+
+def uniform_field(bx, by, bz):
+    '''
+    Field model of a constant field
+    :param bx: field along x, in T
+    :param by: field along y, in T
+    :param bz: field along z, in T
+    :return: field model, function of time
+    '''
+    field = np.array([bx, by, bz], dtype=float)
+
+    def model(t):
+        return np.broadcast_to(field[:, np.newaxis], (3, np.size(t)))
+
+    return model
+
+
+class EmulatedUsbDevice:
+    '''
+    Stands for the pyusb device of the instrument
+    '''
+
+    def __init__(self, probe):
+        self.probe = probe
+
+    def reset(self):
+        self.probe.reset_state()
+
+
+class EmulatedBulkEndpoints:
+    '''
+    Stands for the bulk out and bulk in endpoints of the instrument, serving the pending response in USBTMC
+    transfers of at most the size requested by the last DEV_DEP_MSG_IN request
+    '''
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.bEndpointAddress = 0
+        self.requested = 0
+
+    def write(self, data, timeout=None):
+        self.requested = struct.unpack_from('<L', data, 4)[0]
+
+    def read(self, size_or_buffer, timeout=None):
+        '''
+        As pyusb Endpoint.read: fill the array given, or a new one of the size given
+        :return: number of bytes read if an array was given, else the array read
+        '''
+        if isinstance(size_or_buffer, int):
+            buffer = array.array('B', bytes(size_or_buffer))
+            return buffer[:self.read(buffer, timeout)]
+
+        buffer = size_or_buffer
+        self.instrument.wait_response()
+        response = self.instrument.response
+        chunk, self.instrument.response = response[:self.requested], response[self.requested:]
+
+        btag = self.instrument.last_btag
+        header = struct.pack('<BBBxLBxxx', 2, btag, ~btag & 0xFF, len(chunk), 0 if self.instrument.response else 1)
+        view = memoryview(buffer)
+        view[:len(header)] = header
+        view[len(header):len(header) + len(chunk)] = chunk
+        return len(header) + len(chunk)
+
+
+class EmulatedProbe:
+    '''
+    SCPI state machine of the emulated probe
+    '''
+    id_string = 'Metrolab Technology SA,THM1176-MF,0000000,emulator'
+    full_scales = {'0.1T': 0.1, '0.3T': 0.3, '1T': 1.0, '3T': 3.0}
+    integer_lsb = 1e-9  # field value of one count of the INTEGER format, in T (emulator convention)
+    # Long forms of the SCPI mnemonics used by Thm1176, commands are matched on their short forms
+    short_forms = {'FETCH': 'FETC', 'ARRAY': 'ARR', 'SCALAR': 'SCAL', 'TIMESTAMP': 'TIM', 'TEMPERATURE': 'TEMP',
+                   'SYSTEM': 'SYST', 'ERROR': 'ERR', 'FORMAT': 'FORM', 'SENSE': 'SENS', 'RANGE': 'RANG',
+                   'AVERAGE': 'AVER', 'COUNT': 'COUN', 'TRIGGER': 'TRIG', 'SOURCE': 'SOUR', 'TIMER': 'TIM',
+                   'INITIATE': 'INIT', 'CONTINUOUS': 'CONT', 'ABORT': 'ABOR', 'IMMEDIATE': 'IMM', 'ASCII': 'ASC',
+                   'INTEGER': 'INT'}
+    settings_headers = {'FORM:DATA': 'FORM:DATA', 'FORM': 'FORM:DATA', 'SENS:FLUX:RANG': 'SENS:FLUX:RANG',
+                        'FLUX:RANG': 'SENS:FLUX:RANG', 'AVER:COUN': 'AVER:COUN', 'TRIG:SOUR': 'TRIG:SOUR',
+                        'TRIG:TIM': 'TRIG:TIM', 'TRIG:COUN': 'TRIG:COUN', 'INIT:CONT': 'INIT:CONT'}
+
+    def __init__(self, noise=0.0, field_model=None, sample_time=40e-6, temperature=36000, seed=None, clock_drift=0.0):
+        '''
+
+        :param noise: standard deviation of the field noise of a single, non averaged, sample, in T
+        :param field_model: function of the time in s, returning the (3, n) field values in T at n times
+        :param sample_time: duration of one averaged sample, in s
+        :param temperature: value returned by temperature fetches
+        :param seed: seed of the noise generator
+        :param clock_drift: rate difference of the probe clock with respect to the host clock, in ppm
+        '''
+        self.noise = noise
+        self.field_model = field_model if field_model is not None else uniform_field(0.0, 0.0, 0.0)
+        self.sample_time = sample_time
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+        self.clock_rate = 1.0 + clock_drift * 1e-6  # probe seconds per host second
+        self.clock_origin = time.monotonic()
+        self.reset_state()
+
+    def reset_state(self):
+        '''
+        Back to power-on settings, as after a device reset
+        :return:
+        '''
+        self.settings = {'FORM:DATA': 'ASC', 'SENS:FLUX:RANG': '0.1T', 'AVER:COUN': '1', 'TRIG:SOUR': 'IMM',
+                         'TRIG:TIM': '0.1S', 'TRIG:COUN': '1', 'INIT:CONT': 'OFF'}
+        self.errors = collections.deque()
+        self.opc_pending = None  # time at which the operation flagged by *OPC completes
+        self.opc_done = False
+        self.acquisition = None
+        self.n_fetched = 0
+        self.block = None
+        self.ready = 0.0
+
+    def handle(self, message):
+        '''
+        Execute a command line
+        :param message: command line, ';' separated commands
+        :return: (response, time at which the response is available)
+        '''
+        self.ready = time.monotonic()
+        self.block = None
+        responses = []
+
+        for command in message.strip().split(';'):
+            if not command:
+                continue
+            header, _, argument = command.strip().partition(' ')
+            response = self.execute(self.normalize(header), argument.strip())
+            if response is not None:
+                responses.append(response)
+
+        return (b';'.join(responses) + b'\n' if responses else b''), self.ready
+
+    def normalize(self, header):
+        mnemonics = header.upper().lstrip(':').split(':')
+        return ':'.join(self.short_forms.get(mnemonic.rstrip('?'), mnemonic.rstrip('?')) +
+                        ('?' if mnemonic.endswith('?') else '') for mnemonic in mnemonics)
+
+    def execute(self, header, argument):
+        now = time.monotonic()
+
+        if header in self.settings_headers:
+            self.settings[self.settings_headers[header]] = self.short_forms.get(argument.upper(), argument.upper())
+            return None
+        if header == 'INIT':
+            self.start(now)
+            return None
+        if header == 'ABOR':
+            self.acquisition = None
+            return None
+        if header == '*IDN?':
+            return self.id_string.encode('ascii')
+        if header == '*RST':
+            self.reset_state()
+            return None
+        if header == '*CLS':
+            self.errors.clear()
+            self.opc_done = False
+            return None
+        if header == '*STB?':
+            return str(4 if self.errors else 0).encode('ascii')
+        if header == '*OPC?':
+            self.ready = max(self.ready, self.completion_time())
+            return b'1'
+        if header == '*OPC':
+            self.opc_pending = self.completion_time()
+            return None
+        if header == '*ESR?':
+            if self.opc_pending is not None and now >= self.opc_pending:
+                self.opc_done = True
+                self.opc_pending = None
+            res, self.opc_done = self.opc_done, False
+            return str(int(res)).encode('ascii')
+        if header == 'SYST:ERR?':
+            code, message = self.errors.popleft() if self.errors else (0, 'No error')
+            return '{},"{}"'.format(code, message).encode('ascii')
+
+        match = re.match(r'FETC:(SCAL|ARR):([XYZ])\?$', header)
+        if match:
+            return self.fetch_field(match.group(1), 'XYZ'.index(match.group(2)), argument)
+        if header == 'FETC:TIM?':
+            times = self.current_block()[0]
+            return '0x{:016X}'.format(int(round(times[-1] * 1e9)) if len(times) else 0).encode('ascii')
+        if header == 'FETC:TEMP?':
+            return str(self.temperature).encode('ascii')
+
+        self.errors.append((-113, 'Undefined header'))
+        return None
+
+    def start(self, now):
+        periodic = self.settings['TRIG:SOUR'] == 'TIM'
+        if periodic:
+            step = float(self.settings['TRIG:TIM'].rstrip('S')) / self.clock_rate  # timed by the probe clock
+        else:
+            step = int(self.settings['AVER:COUN']) * self.sample_time
+        count = None if periodic and self.settings['INIT:CONT'] == 'ON' else int(self.settings['TRIG:COUN'])
+
+        self.acquisition = {'start': now, 'step': step, 'count': count}
+        self.n_fetched = 0
+
+    def completion_time(self):
+        if self.acquisition is None or self.acquisition['count'] is None:
+            return time.monotonic()
+        return self.acquisition['start'] + self.acquisition['count'] * self.acquisition['step']
+
+    def current_block(self, n_samples=None):
+        '''
+        Samples of the block fetched by the current command line: the next n_samples samples for array fetches,
+        the last sample of the acquisition for scalar fetches. Waiting for the samples to be acquired is emulated by
+        delaying the response.
+        :return: (times, fields)
+        '''
+        if self.block is not None:
+            return self.block
+
+        if self.acquisition is None:
+            self.block = (np.zeros(0), np.zeros((3, 0)))
+            return self.block
+
+        count = self.acquisition['count']
+        if n_samples is None:
+            first = count - 1 if count is not None else self.n_fetched
+            n_samples = 1
+        else:
+            first = self.n_fetched
+            if count is not None:
+                first = 0
+                n_samples = min(n_samples, count)
+            self.n_fetched += n_samples
+
+        times = self.acquisition['start'] + self.acquisition['step'] * np.arange(first + 1, first + n_samples + 1)
+        self.ready = max(self.ready, times[-1])
+
+        fields = np.array(self.field_model(times - self.clock_origin), dtype=float)
+        if self.noise:
+            noise = self.noise / np.sqrt(int(self.settings['AVER:COUN']))
+            fields = fields + noise * self.rng.standard_normal(fields.shape)
+        full_scale = self.full_scales.get(self.settings['SENS:FLUX:RANG'], 3.0)
+        fields = np.clip(fields, -full_scale, full_scale)
+
+        self.block = ((times - self.clock_origin) * self.clock_rate, fields)
+        return self.block
+
+    def fetch_field(self, kind, axis, argument):
+        args = [arg for arg in argument.split(',') if arg]
+        if kind == 'ARR':
+            n_samples = int(args[0]) if args else 1
+            digits = int(args[1]) if len(args) > 1 else 5
+        else:
+            n_samples = None
+            digits = int(args[0]) if args else 5
+
+        values = self.current_block(n_samples)[1][axis]
+
+        if self.settings['FORM:DATA'] == 'INT':
+            counts = np.round(values / self.integer_lsb).astype('>i4')
+            if kind == 'SCAL':
+                return str(int(counts[0])).encode('ascii')
+            payload = counts.tobytes()
+            length = str(len(payload)).encode('ascii')
+            return b'#' + str(len(length)).encode('ascii') + length + payload
+
+        return ','.join('{:.{}E}T'.format(value, digits) for value in values).encode('ascii')
+
+
+class Thm1176Emulator(usbtmc.Instrument):
+    '''
+    usbtmc Instrument whose transactions are served by an EmulatedProbe
+    '''
+
+    def __init__(self, *args, latency=0.0, noise=0.0, field_model=None, sample_time=40e-6, temperature=36000,
+                 seed=None, realtime=True, clock_drift=0.0, **kwargs):
+        '''
+        usbtmc.Instrument.__init__ is not called, as there is no USB device to look for
+        :param args: ignored, for compatibility with usbtmc.Instrument
+        :param latency: duration of each write and read transaction, in s
+        :param realtime: False to answer without waiting for the emulated acquisitions to complete
+        :param noise: see EmulatedProbe
+        :param field_model: see EmulatedProbe
+        :param sample_time: see EmulatedProbe
+        :param temperature: see EmulatedProbe
+        :param seed: see EmulatedProbe
+        :param clock_drift: see EmulatedProbe
+        :param kwargs: ignored, for compatibility with usbtmc.Instrument
+        '''
+        self.probe = EmulatedProbe(noise, field_model, sample_time, temperature, seed, clock_drift)
+        self.device = EmulatedUsbDevice(self.probe)
+        self.max_transfer_size = 1024 * 1024
+        self.timeout = 5.0
+        self.connected = True
+        self.advantest_quirk = False  # read by usbtmc.Instrument.ask
+        self.advantest_locked = False
+        self.rigol_quirk = False
+        self.term_char = None
+        self.last_btag = 0
+        self.bulk_out_ep = self.bulk_in_ep = EmulatedBulkEndpoints(self)
+
+        self.latency = latency
+        self.realtime = realtime
+        self.response = b''
+        self.response_ready = 0.0
+
+    def open(self):
+        self.connected = True
+
+    def close(self):
+        self.connected = False
+
+    def write_raw(self, data):
+        time.sleep(self.latency)
+        self.response, self.response_ready = self.probe.handle(data.decode('ascii'))
+        if not self.realtime:
+            self.response_ready = 0.0
+
+    def wait_response(self):
+        if not wait_for_response(self.response_ready, self.timeout, self.latency):
+            raise usb.core.USBTimeoutError('Operation timed out', errno=110)
+        self.response_ready = 0.0  # the rest of a response read in several transfers is available at once
+
+    def _abort_bulk_in(self, btag=None):
+        self.response = b''
+
+
+class EmulatedVisaResource:
+    '''
+    Stands for an opened pyvisa resource of the instrument, whose transactions are served by an EmulatedProbe
+    '''
+
+    def __init__(self, latency=0.0, noise=0.0, field_model=None, sample_time=40e-6, temperature=36000, seed=None,
+                 realtime=True, clock_drift=0.0):
+        '''
+
+        :param latency: duration of each write and read transaction, in s
+        :param realtime: False to answer without waiting for the emulated acquisitions to complete
+        :param noise: see EmulatedProbe
+        :param field_model: see EmulatedProbe
+        :param sample_time: see EmulatedProbe
+        :param temperature: see EmulatedProbe
+        :param seed: see EmulatedProbe
+        :param clock_drift: see EmulatedProbe
+        '''
+        self.probe = EmulatedProbe(noise, field_model, sample_time, temperature, seed, clock_drift)
+        self.timeout = 5000  # in ms, as pyvisa
+        self.chunk_size = 20 * 1024
+        self.read_termination = None
+
+        self.latency = latency
+        self.realtime = realtime
+        self.response = b''
+        self.response_ready = 0.0
+
+    def write(self, message):
+        time.sleep(self.latency)
+        self.response, self.response_ready = self.probe.handle(message)
+        if not self.realtime:
+            self.response_ready = 0.0
+
+    def read_raw(self):
+        if not wait_for_response(self.response_ready, self.timeout / 1000.0, self.latency):
+            import pyvisa
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+
+        res, self.response = self.response, b''
+        return res
+
+    def read(self):
+        res = self.read_raw().decode('ascii')
+        if self.read_termination and res.endswith(self.read_termination):
+            res = res[:-len(self.read_termination)]
+        return res
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def clear(self):
+        self.response = b''
+
+    def close(self):
+        pass
+
+
+class EmulatedThm1176(thm_api.Thm1176, Thm1176Emulator):
+    '''
+    Thm1176 driver running on top of the emulator
+    '''
+    pass
@@ -0,0 +1,414 @@
+'''
+Local server owning the THM1176, and its client
+
+Only one process can hold the probe. ProbeServer owns the Thm1176 instance and serves local clients over a Unix
+socket (address given as a path) or localhost TCP (address given as a (host, port) tuple), so that the GUI, the scan
+scripts and monitors can use the probe at the same time without reinitializing it.
+
+Messages are frames made of a header, the message type (1 byte) and the payload length (4 bytes, little endian),
+followed by the payload. Setup parameters and replies to id and setup requests are JSON text, readings and blocks are
+binary: the number of fields (1 byte), then for each field its name length (1 byte), name, number of values (4 bytes)
+and values (little endian float64).
+
+Requests are served one at a time on the probe. A periodic acquisition started by a stream request is shared by all
+clients streaming, each one receiving every block (the oldest blocks are dropped for a client falling behind), and
+is stopped when the last one leaves. Single measurements and setup are refused while the probe is streaming.
+
+    client = ProbeClient(('127.0.0.1', 5025))
+    reading = client.measure(trigger_type='single', average=1000)
+    for block in client.blocks(10, trigger_type='periodic', block_size=100, period=0.01):
+        ...
+'''
+
+import os
+import json
+import queue
+import socket
+import struct
+import threading
+import socketserver
+import numpy as np
+
+default_address = ('127.0.0.1', 5025)
+
+MSG_ID = 1
+MSG_SETUP = 2
+MSG_MEASURE = 3
+MSG_STREAM = 4
+MSG_UNSUBSCRIBE = 5
+MSG_OK = 10
+MSG_READING = 11
+MSG_BLOCK = 12
+MSG_ERROR = 13
+
+header_format = struct.Struct('<BI')
+
+
+def encode_reading(reading):
+    '''
+    :param reading: dict of arrays
+    :return: binary payload
+    '''
+    parts = [struct.pack('<B', len(reading))]
+    for name, values in reading.items():
+        name = name.encode('utf-8')
+        values = np.ascontiguousarray(values, dtype='<f8').ravel()
+        parts.append(struct.pack('<B', len(name)) + name + struct.pack('<I', values.size))
+        parts.append(values.tobytes())
+    return b''.join(parts)
+
+
+def decode_reading(payload):
+    '''
+    :param payload: binary payload, see encode_reading
+    :return: dict of arrays, read only views of the payload
+    '''
+    reading = {}
+    n_fields, = struct.unpack_from('<B', payload)
+    pos = 1
+    for _ in range(n_fields):
+        name_length, = struct.unpack_from('<B', payload, pos)
+        name = bytes(payload[pos + 1:pos + 1 + name_length]).decode('utf-8')
+        pos += 1 + name_length
+        count, = struct.unpack_from('<I', payload, pos)
+        pos += 4
+        reading[name] = np.frombuffer(payload, dtype='<f8', count=count, offset=pos)
+        pos += 8 * count
+    return reading
+
+
+def receive_exactly(sock, n_bytes):
+    data = bytearray(n_bytes)
+    view = memoryview(data)
+    pos = 0
+    while pos < n_bytes:
+        received = sock.recv_into(view[pos:])
+        if not received:
+            raise ConnectionError('Connection closed')
+        pos += received
+    return data
+
+
+def send_frame(sock, msg_type, payload=b''):
+    sock.sendall(header_format.pack(msg_type, len(payload)) + payload)
+
+
+def receive_frame(sock):
+    '''
+    :return: (message type, payload)
+    '''
+    msg_type, length = header_format.unpack(receive_exactly(sock, header_format.size))
+    return msg_type, receive_exactly(sock, length) if length else bytearray()
+
+
+class Subscriber:
+    '''
+    Client connection receiving the blocks of the shared stream
+    '''
+    done = object()
+
+    def __init__(self, connection, queue_size):
+        self.connection = connection
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.sender = threading.Thread(target=self.send_blocks, daemon=True)
+        self.sender.start()
+
+    def push(self, item):
+        while True:
+            try:
+                self.blocks.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.blocks.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def send_blocks(self):
+        while True:
+            item = self.blocks.get()
+            if item is self.done:
+                return
+            try:
+                self.connection.send(*item)
+            except OSError:
+                return
+
+    def close(self):
+        self.push(self.done)
+        self.sender.join()
+
+
+class ProbeConnection:
+    '''
+    Client connection, serializing the frames sent by the request handler and the stream sender
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.subscriber = None
+
+    def send(self, msg_type, payload=b''):
+        with self.lock:
+            send_frame(self.sock, msg_type, payload)
+
+
+class ProbeRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        connection = ProbeConnection(self.request)
+        try:
+            while True:
+                try:
+                    msg_type, payload = receive_frame(self.request)
+                except (ConnectionError, OSError):
+                    return
+                try:
+                    reply = self.server.probe_server.execute(connection, msg_type, payload)
+                except Exception as exc:
+                    reply = (MSG_ERROR, '{}: {}'.format(type(exc).__name__, exc).encode('utf-8'))
+                if reply is None:
+                    # already replied
+                    continue
+                try:
+                    connection.send(*reply)
+                except OSError:
+                    return
+        finally:
+            self.server.probe_server.unsubscribe(connection)
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ProbeServer:
+
+    def __init__(self, thm, address=default_address, queue_size=16):
+        '''
+
+        :param thm: Thm1176 instance, owned by the server from now on
+        :param address: path of a Unix socket, or (host, port) for TCP
+        :param queue_size: number of blocks kept for each streaming client falling behind
+        '''
+        self.thm = thm
+        self.id = thm.get_id()  # served from here, as the probe may be streaming
+        self.address = address
+        self.queue_size = queue_size
+        self.lock = threading.Lock()  # held while a request uses the probe
+
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.stream_params = None
+        self.stream_thread = None
+        self.stop_stream = threading.Event()
+
+        if isinstance(address, str):
+            self.server = ThreadingUnixServer(address, ProbeRequestHandler)
+        else:
+            self.server = ThreadingTCPServer(address, ProbeRequestHandler)
+        self.server.probe_server = self
+
+    def serve_forever(self):
+        print("Probe server listening on {}".format(self.address))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        '''
+        Stop serve_forever, from another thread
+        '''
+        self.server.shutdown()
+
+    def close(self):
+        with self.lock:
+            self.end_stream()
+        self.server.server_close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def execute(self, connection, msg_type, payload):
+        '''
+        Serve a request
+        :return: reply, (message type, payload), or None if the request replied itself
+        '''
+        params = json.loads(payload.decode('utf-8')) if payload else {}
+
+        if msg_type == MSG_STREAM:
+            self.subscribe(connection, params)
+            return None
+        if msg_type == MSG_UNSUBSCRIBE:
+            self.unsubscribe(connection)
+            return MSG_OK, b''
+
+        if msg_type == MSG_ID:
+            return MSG_OK, json.dumps(self.id).encode('utf-8')
+
+        with self.lock:
+            if self.stream_thread is not None:
+                raise RuntimeError('Probe is streaming')
+            if msg_type == MSG_SETUP:
+                self.thm.setup(**params)
+                return MSG_OK, b''
+            if msg_type == MSG_MEASURE:
+                self.thm.make_measurement(**params)
+                return MSG_READING, encode_reading(self.thm.copy_reading())
+
+        raise ValueError('Unknown message type {}'.format(msg_type))
+
+    def subscribe(self, connection, params):
+        '''
+        Add the connection to the stream, starting the stream with params if it is not running, and reply with the
+        setup parameters of the stream. The reply is sent holding the connection lock, so that it reaches the client
+        before the first block.
+        :return:
+        '''
+        with self.lock, connection.lock:
+            if self.stream_thread is None:
+                params = dict(params, trigger_type='periodic')
+                self.thm.setup(**params)
+                self.stream_params = params
+
+            if connection.subscriber is None:
+                with self.subscribers_lock:
+                    connection.subscriber = Subscriber(connection, self.queue_size)
+                    self.subscribers.append(connection.subscriber)
+
+            if self.stream_thread is None:
+                self.stop_stream.clear()
+                self.stream_thread = threading.Thread(target=self.run_stream, daemon=True)
+                self.stream_thread.start()
+
+            send_frame(connection.sock, MSG_OK, json.dumps(self.stream_params).encode('utf-8'))
+
+    def unsubscribe(self, connection):
+        '''
+        Remove the connection from the stream, stopping the stream if it was the last one
+        '''
+        with self.lock:
+            subscriber = connection.subscriber
+            if subscriber is None:
+                return
+            with self.subscribers_lock:
+                self.subscribers.remove(subscriber)
+            connection.subscriber = None
+            subscriber.close()
+
+            if not self.subscribers:
+                self.end_stream()
+
+    def end_stream(self):
+        '''
+        Stop the stream, the lock being held
+        '''
+        if self.stream_thread is not None:
+            self.stop_stream.set()
+            self.stream_thread.join()
+            self.stream_thread = None
+            self.stream_params = None
+
+    def broadcast(self, item):
+        with self.subscribers_lock:
+            for subscriber in self.subscribers:
+                subscriber.push(item)
+
+    def run_stream(self):
+        blocks = self.thm.iter_blocks()
+        try:
+            for block in blocks:
+                self.broadcast((MSG_BLOCK, encode_reading(block)))
+                if self.stop_stream.is_set():
+                    break
+        except Exception as exc:
+            self.broadcast((MSG_ERROR, '{}: {}'.format(type(exc).__name__, exc).encode('utf-8')))
+        finally:
+            blocks.close()
+
+
+class ProbeClient:
+
+    def __init__(self, address=default_address, timeout=None):
+        '''
+
+        :param address: path of the Unix socket, or (host, port) of the server
+        :param timeout: socket timeout, in s
+        '''
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type, params=None, skip_blocks=False):
+        send_frame(self.sock, msg_type, json.dumps(params).encode('utf-8') if params is not None else b'')
+        return self.reply(skip_blocks)
+
+    def reply(self, skip_blocks=False):
+        while True:
+            msg_type, payload = receive_frame(self.sock)
+            if msg_type == MSG_ERROR:
+                raise RuntimeError(payload.decode('utf-8'))
+            if not (skip_blocks and msg_type == MSG_BLOCK):
+                return msg_type, payload
+
+    def get_id(self):
+        '''
+        :return: dict, as Thm1176.get_id
+        '''
+        return json.loads(self.request(MSG_ID)[1].decode('utf-8'))
+
+    def setup(self, **params):
+        self.request(MSG_SETUP, params)
+
+    def measure(self, **params):
+        '''
+        Make a measurement, as Thm1176.make_measurement
+        :param params: setup parameters
+        :return: reading, dict of arrays
+        '''
+        return decode_reading(self.request(MSG_MEASURE, params)[1])
+
+    def blocks(self, n_blocks=None, **params):
+        '''
+        Join the stream of the server, started with params if it is not running yet, and yield its blocks.
+        The connection is dedicated to the stream until the generator is closed.
+        :param n_blocks: number of blocks to receive, None to run until the generator is closed
+        :param params: setup parameters of the periodic acquisition
+        :return: generator of blocks, dicts of arrays
+        '''
+        # blocks of the stream arriving before the reply (none from this server) are skipped
+        self.stream_params = json.loads(self.request(MSG_STREAM, params, skip_blocks=True)[1].decode('utf-8'))
+        try:
+            count = 0
+            while n_blocks is None or count < n_blocks:
+                msg_type, payload = self.reply()
+                if msg_type == MSG_BLOCK:
+                    yield decode_reading(payload)
+                    count += 1
+        finally:
+            send_frame(self.sock, MSG_UNSUBSCRIBE)
+            self.reply(skip_blocks=True)
@@ -0,0 +1,54 @@
+'''
+Probe session kept open across measurement runs
+
+Creating a Thm1176 opens the USB device and checks (or resets) the probe, which takes from tens of milliseconds to
+more than a second. A ProbeSession creates the driver once and hands the same instance to each run, only applying
+the settings that changed, so that starting a scan costs milliseconds.
+'''
+
+import threading
+import usbtmc
+
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+
+
+class ProbeSession:
+
+    def __init__(self, device=None, factory=None):
+        '''
+
+        :param device: usbtmc device of the probe, the first usbtmc device found if None
+        :param factory: callable creating the driver from setup parameters, instead of thm_api.Thm1176(device, ...)
+        '''
+        self.device = device
+        self.factory = factory
+        self.thm = None
+        self.lock = threading.Lock()
+
+    def acquire(self, **params):
+        '''
+        Get the probe driver, set up with params. It is created on first use, and checked for responsiveness (reset
+        if needed) on later ones.
+        :param params: setup parameters
+        :return: Thm1176 instance
+        '''
+        with self.lock:
+            if self.thm is None:
+                if self.factory is not None:
+                    self.thm = self.factory(**params)
+                else:
+                    if self.device is None:
+                        self.device = usbtmc.list_devices()[0]
+                    self.thm = thm_api.Thm1176(self.device, **params)
+                return self.thm
+
+            if not self.thm.is_responsive():
+                self.thm.reset_device()
+            self.thm.setup(**params)
+            return self.thm
+
+    def close(self):
+        with self.lock:
+            if self.thm is not None:
+                self.thm.close()
+                self.thm = None
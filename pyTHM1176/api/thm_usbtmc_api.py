@@ -14,14 +14,6 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 
-functions
-parse_ieee_block_header
-from_binary_block
-_use_numpy_routines
-are copied from pyVISA library
-copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
-license: MIT, see pyVISA LICENSE for more details.
-
 
 Interaction with Metrolab's THM1176 field probe based on usbtmc backend
 
@@ -29,395 +21,106 @@ usbtmc preferred over VISA as VISA library has limited availability for Linux. u
 
 VISA preferred on Windows, as use of usbtmc requires manual change of USB driver (libusb instead of standard)
 
+The protocol itself is implemented by thm_core.Thm1176Core, shared with the VISA backend
+
 Author: Cedric Hugon
 Date: 16Apr2018
 '''
 
+import array
 import struct
-import inspect
-import usbtmc
 import time
-import numpy as np
-
-
-def _use_numpy_routines(container):
-    """Should optimized numpy routines be used to extract the data.
-    """
-    # Function copied from pyVISA
-    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
-    # license: MIT, see pyVISA LICENSE for more details.
-    if np is None or container in (tuple, list):
-        return False
-
-    if (container is np.array or (inspect.isclass(container) and
-                                  issubclass(container, np.ndarray))):
-        return True
-
-    return False
-
-
-def parse_ieee_block_header(block):
-    """
-    Parse the header of a IEEE block.
-    Definite Length Arbitrary Block:
-    #<header_length><data_length><data>
-    The header_length specifies the size of the data_length field.
-    And the data_length field specifies the size of the data.
-    Indefinite Length Arbitrary Block:
-    #0<data>
-    :param block: IEEE block.
-    :type block: bytes | bytearray
-    :return: (offset, data_length)
-    :rtype: (int, int)
-    """
-    # Function copied from pyVISA
-    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
-    # license: MIT, see pyVISA LICENSE for more details.
-
-    begin = block.find(b'#')
-    if begin < 0:
-        raise ValueError("Could not find hash sign (#) indicating the start of"
-                         " the block.")
-
-    try:
-        # int(block[begin+1]) != int(block[begin+1:begin+2]) in Python 3
-        header_length = int(block[begin + 1:begin + 2])
-    except ValueError:
-        header_length = 0
-    offset = begin + 2 + header_length
-
-    if header_length > 0:
-        # #3100DATA
-        # 012345
-        data_length = int(block[begin + 2:offset])
-    else:
-        # #0DATA
-        # 012
-        data_length = len(block) - offset - 1
-
-    return offset, data_length
-
-
-def from_binary_block(block, offset=0, data_length=None, datatype='f',
-                      is_big_endian=False, container=list):
-    """
-    Convert a binary block into an iterable of numbers.
-    :param block: binary block.
-    :type block: bytes | bytearray
-    :param offset: offset at which the data block starts (default=0)
-    :param data_length: size in bytes of the data block
-                        (default=len(block) - offset)
-    :param datatype: the format string for a single element. See struct module.
-    :param is_big_endian: boolean indicating endianess.
-    :param container: container type to use for the output data.
-    :return: items
-    :rtype: type(container)
-    """
-    # Function copied from pyVISA
-    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
-    # license: MIT, see pyVISA LICENSE for more details.
-
-    if data_length is None:
-        data_length = len(block) - offset
-
-    element_length = struct.calcsize(datatype)
-    array_length = int(data_length / element_length)
-
-    endianess = '>' if is_big_endian else '<'
-
-    if _use_numpy_routines(container):
-        return np.frombuffer(block, endianess + datatype, array_length, offset)
-
-    fullfmt = '%s%d%s' % (endianess, array_length, datatype)
+import usb.core
+import usbtmc
 
-    try:
-        return container(struct.unpack_from(fullfmt, block, offset))
-    except struct.error:
-        raise ValueError("Binary data was malformed")
+from pyTHM1176.api.thm_core import Thm1176Core
+# Formerly defined here, still importable from this module
+from pyTHM1176.api.thm_core import decode_binary_fetch, parse_ieee_block_header, from_binary_block  # noqa: F401
 
 
-class Thm1176(usbtmc.Instrument):
-    ranges = ["0.1T", '0.3T', '1T', '3T']
-    trigger_period_bounds = (122e-6, 2.79)
-    base_fetch_cmd = {"periodic": ':FETCh:ARRay:', "single": ":FETCh:SCALar:"}
-    axes = ['X', 'Y', 'Z']
-    field_axes = ['Bx', 'By', 'Bz']
-    fetch_kinds = ['Bx', 'By', 'Bz', 'Timestamp',
-                   'Temperature']  # Order matters, this is linked to the fetch command that is sent to retrived data
-    n_digits = 5
-    defaults = {'block_size': 10, 'period': 0.5, 'range': '0.1T', 'average': 1, 'format': 'INTEGER'}
-    id_fields = ['manufacturer', 'model', 'serial', 'version']
+class Thm1176(Thm1176Core, usbtmc.Instrument):
+    transport_errors = (usb.core.USBError, usbtmc.usbtmc.UsbtmcException, UnicodeDecodeError)
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        # resolve issue of device left hanging to dry and timing out
-        self.device.reset()
-        # need to provide some time for device to reset before proceeding
-        time.sleep(0.5)
-
-        self.running = False
-        self.stop = False
-
-        self.fetch_cmd = None
-
-        self.max_transfer_size = 49216  # (4096 samples * 3 axes * 4B/sample + 64B for time&temp&...
-        self.timeout = 10
-
-        self.block_size = self.defaults['block_size']
-        self.period = self.defaults['period']
-        self.range = self.defaults['range']
-        self.average = self.defaults['average']
-        self.format = self.defaults['format']
-
-        self.last_reading = {fetch_kind: None for fetch_kind in self.fetch_kinds}
-        self.data_stack = {fetch_kind: [] for fetch_kind in self.fetch_kinds}
-        self.errors = []
-
-        self.setup(**kwargs)
-
-    def set_format(self):
-        self.write(':FORMAT:DATA ' + self.format)
-
-    def set_average(self):
-
-        self.write(':AVERAGE:COUNT {}'.format(self.average))
-
-    def set_range(self):
-        '''
-        Set sense range of the Metrolab THM1176
-        Possible ranges are 0.1T,0.3T,1T,3T
-        :param range_str:
-        :return:
         '''
 
-        self.write(':SENSe:FLUX:RANGe ' + self.range)
-
-    def set_trigger(self, trigger_type):
-        '''
-        Set the probe to run in periodic trigger mode with a given period, continuously
-        :param period:
-        :return:
+        :param args: device, see usbtmc.Instrument
+        :param kwargs: setup parameters, see Thm1176Core
         '''
+        # Buffers reused by read_raw_into_buffer: USB transfers are received in receive_buffer, and responses longer
+        # than a transfer assembled in assembly_buffer. Both are sized on first use
+        self.receive_buffer = array.array('B')
+        self.assembly_buffer = bytearray()
 
-        if trigger_type == "periodic":
-            if self.trigger_period_bounds[0] <= self.period <= self.trigger_period_bounds[1]:
-                self.write(':TRIGger:SOURce TIMer')
-                self.write(':TRIGger:TIMer {:f}S'.format(self.period))
-                self.write(':TRIG:COUNT {}'.format(self.block_size))
-                self.write(':INIT:CONTINUOUS ON')
-                return True
-            else:
-                print('Invalid trigger period value.')
-                return False
-        elif trigger_type == "single":
-            self.write(':TRIG:COUNT 1')
-            self.write(':TRIGger:SOURce IMMediate')
-            return True
-        else:
-            return False
-
-    def str_conv(self, input_str, kind):
-        if kind == 'Timestamp':
-            val = int(input_str, 0) * 1e-9
-            time_offset = val - (self.block_size - 1) * self.period
-            res = np.linspace(time_offset, val, self.block_size)
-        elif kind == 'Temperature':
-            res = int(input_str) * np.ones(self.block_size)
-
-        else:
-            res = np.fromstring(input_str.replace('T', ''), sep=',')
-
-        return res
-
-    def parse_ascii_responses(self, kind, res_in):
-        '''
-
-        :param kind:
-        :return:
-        '''
-        if kind == 'fetch':
-            parsed = res_in.split(';')
-
-            for idx, key in enumerate(self.fetch_kinds):
-                self.last_reading[key] = self.str_conv(parsed[idx], key)
-
-            if parsed[-1] == '4':
-                res = self.ask(':SYSTEM:ERROR?;*STB?')
-                self.errors.append(res)
-                while res[0] != '0':
-                    print("Error code: {}".format(res))
-                    res = self.ask(':SYSTEM:ERROR?;*STB?')
-                    self.errors.append(res)
-
-    def parse_binary_responses(self, kind, res_in):
-
-        if kind == 'fetch':
-            glob_offset = 0
-
-            for idx, key in enumerate(self.fetch_kinds[:3]):
-                offset, length = parse_ieee_block_header(res_in)
-                glob_offset += offset
-                self.last_reading[key] = from_binary_block(res_in, offset=glob_offset, data_length=length,
-                                                           datatype='i', is_big_endian=True, container=np.array)
-                glob_offset += length + 4
-
-            glob_offset -= 3  # separation between last binary block and timestamp string is only one byte isntead of 4
-            parsed = res_in[glob_offset:].split(b';')
-            for idx, key in enumerate(self.fetch_kinds[3:]):
-                self.last_reading[key] = self.str_conv(parsed[idx].decode('ascii'), key)
-
-            ending = parsed[-1].decode('ascii')
-            if ending.split('\n')[0] == '4':
-                res = self.ask(':SYSTEM:ERROR?;*STB?')
-                self.errors.append(res)
-                while res[0] != '0':
-                    print("Error code: {}".format(res))
-                    res = self.ask(':SYSTEM:ERROR?;*STB?')
-                    self.errors.append(res)
-
-    def get_id(self):
-        '''
-        Get the identification string of the instrument.
-        Parse it according to expected format specified by docs.
-        :return:
-        '''
-        self.write('*IDN?')
-        res = self.read()
-        id_vals = res.split(',')
-        header = {field: val for field, val in zip(self.id_fields, id_vals)}
-
-        return header
+        super().__init__(*args, **kwargs)
 
-    def get_data_array(self):
+    def reset_device(self):
         '''
-        Fetch data from probe buffer
+        USB reset of the probe, bringing it back to a known state
         :return:
         '''
-        if self.running:
+        # resolve issue of device left hanging to dry and timing out
+        self.device.reset()
+        # need to provide some time for device to reset before proceeding
+        time.sleep(0.5)
+        self.invalidate_config()
 
-            if self.format == 'ASCII':
-                res = self.ask(self.fetch_cmd)
-                self.parse_ascii_responses('fetch', res)
+    def write(self, message, *args, **kwargs):
+        with self.command(str(message)):
+            return super().write(message, *args, **kwargs)
 
-            elif self.format == 'INTEGER':
+    def ask(self, message, *args, **kwargs):
+        with self.command(str(message)):
+            return super().ask(message, *args, **kwargs)
 
-                self.write(self.fetch_cmd)
-                res = self.read_raw()
-                self.parse_binary_responses('fetch', res)
+    def read_raw(self, *args, **kwargs):
+        with self.command('read_raw'):
+            return super().read_raw(*args, **kwargs)
 
-    def setup(self, **kwargs):
+    def read_raw_into_buffer(self):
         '''
-
-        :param kwargs:
-        :return:
+        Read a response as read_raw does, but into the receive buffer instead of new bytes objects, for high rate
+        acquisitions. A response fitting in a single USB transfer is left where the transfer put it, longer ones are
+        assembled in the assembly buffer. Decoding the returned view (e.g. with np.frombuffer) copies nothing.
+        :return: memoryview of the response, only valid until the next read
         '''
-        keys = list(kwargs.keys())
-        trigger_type = kwargs["trigger_type"]
-
-        cmd = ''
-
-        if trigger_type == "periodic":
-            # This will setup the sensor to acquire continuously with a set time period
-            # Acquisition will be started with the "INITiate" command and data should be fetched on time with "FETCh:ARRay"
-            if 'block_size' in keys:
-                self.block_size = kwargs['block_size']
-
-            if 'period' in keys:
-                if self.trigger_period_bounds[0] <= kwargs['period'] <= self.trigger_period_bounds[1]:
-                    self.period = kwargs['period']
-                else:
-                    print('Invalid trigger period value.')
-                    print('Setting to default...')
-                    self.period = self.defaults['period']
-
-            self.set_trigger("periodic")
-
-            for axis in self.axes:
-                cmd += self.base_fetch_cmd["periodic"] + axis + '? {},{};'.format(self.block_size, self.n_digits)
-
-        elif trigger_type == "single":
-            # This will setup the sensor to acquire a single trigger
-            # Acquisition should be started by "READ" and data obtained via FETCH
-            self.set_trigger("single")
-            self.block_size = 1 # needed for data unpacking
-
-            for axis in self.axes:
-                cmd += self.base_fetch_cmd["single"] + axis + '? {};'.format(self.n_digits)
-
-        else:
-            print("Invalid trigger type! Nothing setup.")
-            return
-
-        if 'range' in keys:
-            if kwargs['range'] in self.ranges:
-                self.range = kwargs['range']
-
-        if 'average' in keys:
-            self.average = kwargs['average']
-
-        if 'format' in keys:
-            self.format = kwargs['format']
-
-        self.set_format()
-        self.set_range()
-        self.set_average()
-
-        cmd += ':FETCH:TIMESTAMP?;:FETCH:TEMPERATURE?;*STB?'
-        self.fetch_cmd = cmd
-
-    def make_measurement(self, **kwargs):
-        """
-        To be used for single, one-off acquisition with parameters supplied (may have averaging)
-        :return:
-        """
-        self.setup(**kwargs)
-        self.write(":INIT")
-        time.sleep(0.1)
-        if self.format == 'ASCII':
-            res = self.ask(self.fetch_cmd)
-            self.parse_ascii_responses('fetch', res)
-
-        elif self.format == 'INTEGER':
-            print("INTEGER mode is not working properly right now")
-            self.write(self.fetch_cmd)
-            res = self.read_raw()
-            self.parse_binary_responses('fetch', res)
-
-    def start_acquisition(self):
-        """
-        starts a data acquisition
-        To be used for continuous periodic measurements only
-        The sensor should be set up first, using the setup method
-        :return:
-        """
-        self.running = True
-        self.stop = False
-        self.write(':INIT')
-        while not self.stop:
-            self.get_data_array()
-
-            self.data_stack = {key: np.hstack((self.data_stack[key], self.last_reading[key])) for key in
-                               self.fetch_kinds}
-
-        self.stop_acquisition()
-        self.running = False
-
-    def stop_acquisition(self):
-        """
-        To be used for continuous periodic measurements
-        This is the method to stop a continuous acquisition that was started by the start_acquisition method
-        :return:
-        """
-        res = self.ask(':ABORT;*STB?')
-        print("Stopping acquisition...")
-        print("THM1176 status: {}".format(res))
-
-    def check_error(self):
-
-        res = self.ask(':SYSTEM:ERROR?;*STB?')
-        self.errors.append(res)
-        while res[0] != '0':
-            print("Error code: {}".format(res))
-            res = self.ask(':SYSTEM:ERROR?;*STB?')
-            self.errors.append(res)
+        if self.rigol_quirk or self.advantest_quirk:
+            return memoryview(self.read_raw())
+        if not self.connected:
+            self.open()
+
+        header_size = usbtmc.usbtmc.USBTMC_HEADER_SIZE
+        if len(self.receive_buffer) < self.max_transfer_size + header_size + 3:
+            self.receive_buffer = array.array('B', bytes(self.max_transfer_size + header_size + 3))
+        received = memoryview(self.receive_buffer)
+        timeout = int(self.timeout * 1000)
+        length = 0
+
+        with self.command('read_raw'):
+            try:
+                while True:
+                    request = self.pack_dev_dep_msg_in_header(self.max_transfer_size, self.term_char)
+                    self.bulk_out_ep.write(request, timeout=timeout)
+                    self.bulk_in_ep.read(self.receive_buffer, timeout=timeout)
+
+                    transfer_size, transfer_attributes = struct.unpack_from('<LB', self.receive_buffer, 4)
+                    data = received[header_size:header_size + transfer_size]
+                    end_of_message = transfer_attributes & 1
+                    if end_of_message and length == 0:
+                        return data
+
+                    if len(self.assembly_buffer) < length + transfer_size:
+                        # A new buffer, as the previous one may still be viewed by the arrays of the last reading
+                        assembly_buffer = bytearray(2 * (length + transfer_size))
+                        assembly_buffer[:length] = self.assembly_buffer[:length]
+                        self.assembly_buffer = assembly_buffer
+                    self.assembly_buffer[length:length + transfer_size] = data
+                    length += transfer_size
+                    if end_of_message:
+                        return memoryview(self.assembly_buffer)[:length]
+
+            except usb.core.USBError as exc:
+                if exc.errno == 110:
+                    # timeout, abort transfer
+                    self._abort_bulk_in()
+                raise
@@ -0,0 +1,69 @@
+"""
+Benchmark of device averaging against host averaging of periodic blocks
+
+For each range and total averaging time, a point is measured repeatedly either as a single measurement averaged by
+the probe (:AVERAGE:COUNT), or as a periodic block averaged on the host (Thm1176.make_block_measurement), each sample
+of the block being averaged by the probe over most of the period. The time per point and the spread of the point
+values over the repeats are reported, to pick the faster mode for a given noise level and range.
+"""
+
+import sys
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+import time
+
+import numpy as np
+import usbtmc as backend
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+from pyTHM1176.api.thm_emulator import EmulatedThm1176, uniform_field
+
+emulate_probe = False  # use the software THM1176 instead of the probe
+ranges = ['0.1T', '0.3T', '1T', '3T']
+averaging_times = [0.04, 0.4, 1.2]  # total averaging time per point, in s (1.2 s is 'average': 30000)
+host_period = 1.0 / 2000.0  # trigger period of the host averaged blocks, in s
+n_repeat = 10
+params = {"trigger_type": "single", 'range': '0.1T', 'average': 1, 'format': 'ASCII'}
+
+
+def time_points(measure):
+    values = []
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        stats = measure()
+        values.append([stats[key]['mean'] for key in thm.field_axes])
+    elapsed = (time.perf_counter() - start) / n_repeat
+    return elapsed, np.std(values, axis=0, ddof=1).max()
+
+
+if __name__ == "__main__":
+
+    if emulate_probe:
+        thm = EmulatedThm1176(latency=1e-3, noise=1e-5, field_model=uniform_field(0.0, 0.0, 0.05), **params)
+    else:
+        thm = thm_api.Thm1176(backend.list_devices()[0], **params)
+
+    # Duration of one averaged sample, as first estimated by the driver (refined by each measurement)
+    time_per_average = thm.acq_time_per_average
+    # Average each sample of the host blocks over most of the period, leaving time for the probe overhead
+    sample_average = max(int(0.8 * host_period / time_per_average), 1)
+
+    print('{:>6} {:>10} {:>8} {:>12} {:>14} {:>8} {:>12} {:>14}'.format(
+        'range', 'avg. time', 'average', 'device [s]', 'device spread', 'block', 'host [s]', 'host spread'))
+    for field_range in ranges:
+        for averaging_time in averaging_times:
+            average = int(round(averaging_time / time_per_average))
+            block_size = min(max(int(round(averaging_time / host_period)), 2), thm.max_block_size)
+
+            t_device, spread_device = time_points(
+                lambda: thm.make_burst_measurement(1, **dict(params, range=field_range, average=average)))
+            t_host, spread_host = time_points(
+                lambda: thm.make_block_measurement(block_size, host_period,
+                                                   **dict(params, range=field_range, average=sample_average)))
+
+            print('{:>6} {:>10.3f} {:>8} {:>12.4f} {:>14.3e} {:>8} {:>12.4f} {:>14.3e}'.format(
+                field_range, averaging_time, average, t_device, spread_device, block_size, t_host, spread_host))
+
+    thm.close()
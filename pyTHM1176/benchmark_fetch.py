@@ -0,0 +1,77 @@
+"""
+Benchmark of the decoding of THM1176 fetch responses, ASCII versus INTEGER (binary) format
+
+Responses are synthesized with the layout produced by Thm1176.setup, so no probe is needed.
+For each block size, the size of the transfer and the time needed to decode it are reported, for the former per
+field string conversion of ASCII responses, the compiled AsciiFetchParser, and the INTEGER format.
+"""
+
+import sys
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+import timeit
+import warnings
+
+import numpy as np
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+from pyTHM1176.api.fetch_parser import AsciiFetchParser
+
+block_sizes = [1, 10, 500, 4096]
+period = 1.0 / 2000.0
+n_repeat = 200
+tail = b';0x000000012A05F200;36000;0\n'
+
+
+def make_ascii_response(block_size):
+    fields = []
+    for axis in range(3):
+        values = 1e-3 * (axis + 1) + 1e-6 * np.random.randn(block_size)
+        fields.append(','.join('{:.5E}T'.format(val) for val in values))
+    return ';'.join(fields) + tail.decode('ascii').rstrip('\n')
+
+
+def make_binary_response(block_size):
+    fields = []
+    for axis in range(3):
+        payload = np.random.randint(-2 ** 20, 2 ** 20, block_size).astype('>i4').tobytes()
+        length = str(len(payload)).encode('ascii')
+        fields.append(b'#' + str(len(length)).encode('ascii') + length + payload)
+    return b';'.join(fields) + tail
+
+
+def decode_ascii_legacy(res, block_size):
+    # Per field string conversion, as Thm1176.str_conv
+    parsed = res.split(';')
+    fields = [np.fromstring(parsed[idx].replace('T', ''), sep=',') for idx in range(3)]
+    val = int(parsed[3], 0) * 1e-9
+    timestamp = np.linspace(val - (block_size - 1) * period, val, block_size)
+    temperature = int(parsed[4]) * np.ones(block_size)
+    return fields, timestamp, temperature
+
+
+def decode_binary(res):
+    return thm_api.decode_binary_fetch(res, 3)[0]
+
+
+if __name__ == "__main__":
+    warnings.simplefilter('ignore', DeprecationWarning)  # np.fromstring
+
+    print('{:>10} {:>12} {:>12} {:>14} {:>14} {:>14}'.format('block', 'ASCII [B]', 'INTEGER [B]', 'legacy [us]',
+                                                          'parser [us]', 'INTEGER [us]'))
+    for block_size in block_sizes:
+        res_ascii = make_ascii_response(block_size).rstrip('\n')
+        res_binary = make_binary_response(block_size)
+        parser = AsciiFetchParser(['Bx', 'By', 'Bz'], block_size, period)
+
+        def timing(func):
+            return min(timeit.repeat(func, number=n_repeat, repeat=5)) / n_repeat * 1e6
+
+        t_legacy = timing(lambda: decode_ascii_legacy(res_ascii, block_size))
+        t_parser = timing(lambda: parser.parse(res_ascii))
+        t_binary = timing(lambda: decode_binary(res_binary))
+
+        print('{:>10} {:>12} {:>12} {:>14.1f} {:>14.1f} {:>14.1f}'.format(block_size, len(res_ascii), len(res_binary),
+                                                                       t_legacy, t_parser, t_binary))
@@ -0,0 +1,62 @@
+"""
+Sustained rate benchmark of the receive path of binary (INTEGER) periodic acquisitions
+
+Blocks are fetched and decoded back to back from the emulated probe, answering as soon as asked, either through
+read_raw (a new bytes object per USB transfer and per response) or through read_raw_into_buffer (preallocated
+receive buffer, decoded in place). The number of blocks per second and the equivalent sample rate are reported,
+to compare with the acquisition rate they have to sustain.
+"""
+
+import sys
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+import time
+
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+from pyTHM1176.api.thm_emulator import EmulatedThm1176, uniform_field
+
+block_sizes = [100, 500, 4096]
+period = 1.0 / 2000.0
+duration = 5.0  # per path and block size, in s
+n_slices = 20
+
+
+def sustained_rates(thm, receivers):
+    """
+    Fetch and decode blocks with each receive function in turn, in short alternating slices so that both see the
+    same machine load
+    :return: blocks per second, for each receive function
+    """
+    n_blocks = [0] * len(receivers)
+    elapsed = [0.0] * len(receivers)
+    for _ in range(n_slices):
+        for idx, receive in enumerate(receivers):
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration / n_slices:
+                thm.write(thm.fetch_cmd)
+                thm_api.decode_binary_fetch(receive(), len(thm.axes))
+                n_blocks[idx] += 1
+            elapsed[idx] += time.perf_counter() - start
+    return [n / t for n, t in zip(n_blocks, elapsed)]
+
+
+if __name__ == "__main__":
+
+    params = {"trigger_type": "periodic", 'period': period, 'range': '0.1T', 'average': 1, 'format': 'INTEGER'}
+    thm = EmulatedThm1176(field_model=uniform_field(0.0, 0.0, 0.05), realtime=False, **params)
+
+    print('{:>8} {:>16} {:>16} {:>16} {:>16}'.format('block', 'read_raw [1/s]', 'buffer [1/s]', 'read_raw [S/s]',
+                                                     'buffer [S/s]'))
+    for block_size in block_sizes:
+        thm.setup(**dict(params, block_size=block_size))
+        thm.write(':INIT')
+
+        rate_raw, rate_buffer = sustained_rates(thm, [thm.read_raw, thm.read_raw_into_buffer])
+        thm.write(':ABORT')
+
+        print('{:>8} {:>16.0f} {:>16.0f} {:>16.0f} {:>16.0f}'.format(block_size, rate_raw, rate_buffer,
+                                                                     rate_raw * block_size, rate_buffer * block_size))
+    print('Acquisition rate: {:.0f} S/s'.format(1 / period))
@@ -0,0 +1,162 @@
+"""
+Conformance check and benchmark of the usbtmc and VISA backends, run against the emulated probe
+
+Both backends share the protocol core (thm_core.Thm1176Core), and only differ by their transport. The same sequence
+of operations is run on each one, each check printing PASS or FAIL, and the readings of both backends are compared.
+The rates of single measurements and of back to back periodic block fetches are then reported per backend.
+The script exits with status 1 as soon as a check fails, before the rates, so that it can gate CI; --checks-only
+skips the rates altogether.
+No probe (nor VISA library installation) is needed: the transports are emulated, pyvisa itself is only needed to
+import the VISA backend.
+"""
+
+import sys
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+import time
+
+import numpy as np
+import pyTHM1176.api.thm_visa_api as thm_visa_api
+from pyTHM1176.api.thm_emulator import EmulatedThm1176, EmulatedVisaResource, EmulatedProbe, uniform_field
+
+field = (0.01, -0.02, 0.05)
+params = {"trigger_type": "single", 'range': '0.1T', 'average': 10, 'format': 'ASCII'}
+benchmark_duration = 2.0  # per benchmark and backend, in s
+
+
+def make_backends(**emulation):
+    emulation = dict(dict(field_model=uniform_field(*field)), **emulation)
+    return {'usbtmc': EmulatedThm1176(**dict(emulation, **params)),
+            'VISA': thm_visa_api.Thm1176(EmulatedVisaResource(**emulation), **params)}
+
+
+def field_values(thm):
+    scale = EmulatedProbe.integer_lsb if thm.format == 'INTEGER' else 1.0
+    return np.array([np.asarray(thm.last_reading[key], dtype=float) * scale for key in thm.field_axes])
+
+
+def check_id(thm):
+    return thm.get_id()['manufacturer'].startswith('Metrolab')
+
+
+def check_single(thm, data_format):
+    thm.make_measurement(**dict(params, format=data_format))
+    return np.allclose(field_values(thm)[:, 0], field, atol=1e-5)
+
+
+def check_burst(thm):
+    stats = thm.make_burst_measurement(20, **params)
+    return all(len(stats[key]['samples']) == 20 for key in thm.field_axes)
+
+
+def check_blocks(thm, data_format):
+    thm.setup(**dict(params, trigger_type='periodic', block_size=50, period=0.001, format=data_format))
+    blocks = list(thm.iter_blocks(3))
+    return len(blocks) == 3 and all(block['Bz'].shape == (50,) for block in blocks)
+
+
+def check_layout(thm):
+    layout = dict(params, fetch_axes='Z', fetch_timestamp=False, temperature_every=0)
+    thm.make_measurement(**layout)
+    res = np.isnan(thm.last_reading['Bx'][0]) and np.isclose(thm.last_reading['Bz'][0], field[2], atol=1e-5)
+    thm.setup(**dict(params, fetch_axes='XYZ', fetch_timestamp=True, temperature_every=1))
+    return res
+
+
+def check_errors(thm):
+    n_errors = len(thm.errors)
+    thm.write(':NOT:A:COMMAND')
+    thm.make_measurement(**params)
+    return len(thm.errors) == n_errors + 1 and thm.errors[-1][1] == -113
+
+
+checks = [('identification', check_id),
+          ('single ASCII', lambda thm: check_single(thm, 'ASCII')),
+          ('single INTEGER', lambda thm: check_single(thm, 'INTEGER')),
+          ('burst', check_burst),
+          ('periodic blocks ASCII', lambda thm: check_blocks(thm, 'ASCII')),
+          ('periodic blocks INTEGER', lambda thm: check_blocks(thm, 'INTEGER')),
+          ('fetch layout', check_layout),
+          ('error draining', check_errors)]
+
+
+def run_checks(backends):
+    '''
+    Run every check on each backend, and compare their readings
+    :return: number of failures
+    '''
+    n_failed = 0
+    print('{:<28}'.format('check') + ''.join('{:>10}'.format(name) for name in backends))
+    for name, check in checks:
+        results = []
+        for thm in backends.values():
+            try:
+                results.append(bool(check(thm)))
+            except Exception as exc:
+                print('{} raised {!r}'.format(name, exc))
+                results.append(False)
+        n_failed += results.count(False)
+        print('{:<28}'.format(name) + ''.join('{:>10}'.format('PASS' if res else 'FAIL') for res in results))
+
+    # Both backends should decode the same responses identically
+    try:
+        readings = []
+        for thm in backends.values():
+            thm.make_burst_measurement(5, **params)
+            readings.append(field_values(thm))
+        same = np.array_equal(readings[0], readings[1])
+    except Exception as exc:
+        print('identical readings raised {!r}'.format(exc))
+        same = False
+    n_failed += not same
+    print('{:<28}{:>20}'.format('identical readings', 'PASS' if same else 'FAIL'))
+    return n_failed
+
+
+def rate(func):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < benchmark_duration:
+        func()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+
+    backends = make_backends()
+    for thm in backends.values():
+        thm.error_handler = lambda error: None  # errors are expected, and checked
+
+    n_failed = run_checks(backends)
+    if n_failed:
+        print('\n{} check(s) failed'.format(n_failed))
+        sys.exit(1)
+    if '--checks-only' in sys.argv[1:]:
+        print('\nAll checks passed')
+        sys.exit(0)
+
+    # Rates, with responses served as soon as asked
+    backends = make_backends(realtime=False)
+    print('\n{:<28}'.format('rate [1/s]') + ''.join('{:>10}'.format(name) for name in backends))
+    for name, data_format, block_size in [('single ASCII', 'ASCII', None), ('single INTEGER', 'INTEGER', None),
+                                          ('blocks of 500 ASCII', 'ASCII', 500),
+                                          ('blocks of 500 INTEGER', 'INTEGER', 500)]:
+        rates = []
+        for thm in backends.values():
+            if block_size is None:
+                rates.append(rate(lambda: thm.make_measurement(**dict(params, format=data_format))))
+            else:
+                thm.setup(**dict(params, trigger_type='periodic', block_size=block_size, period=0.0005,
+                                 format=data_format))
+                thm.running = True
+                thm.write(':INIT')
+                rates.append(rate(thm.fetch_reading))
+                thm.write(':ABORT')
+                thm.running = False
+        print('{:<28}'.format(name) + ''.join('{:>10.0f}'.format(res) for res in rates))
+
+    print('\nAll checks passed')
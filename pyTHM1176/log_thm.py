@@ -75,8 +75,6 @@ if __name__ == '__main__':
         # You may want to have a smarter way of fetching the resource name
         thm = thm_api.Thm1176(thm_res, **params)
 
-    data_stack = []  # list is thread safe
-
     # Get device id string and print output. This can be used to check communications are OK
     device_id = thm.get_id()
     for key in thm.id_fields:
@@ -94,8 +92,9 @@ if __name__ == '__main__':
     plt.draw()
 
     plt.pause(5)  # Wait for the monitor to start filling data in
-    plotdata = [thm.data_stack[key] for key in item_name]
-    timeline = thm.data_stack['Timestamp']
+    data_stack = thm.data_stack  # consistent copy of the acquired samples
+    plotdata = [data_stack[key] for key in item_name]
+    timeline = data_stack['Timestamp']
 
     # Setup colors
     NTemp = curve_type.count('T')
@@ -137,8 +136,9 @@ if __name__ == '__main__':
     while time.time() - time_start < duration:
         try:
             plt.pause(1)
-            plotdata = [thm.data_stack[key] for key in item_name]
-            timeline = thm.data_stack['Timestamp']
+            data_stack = thm.data_stack
+            plotdata = [data_stack[key] for key in item_name]
+            timeline = data_stack['Timestamp']
 
             count = 0
             for k, flag in enumerate(to_show):
@@ -0,0 +1,33 @@
+"""
+Run the probe server: open the THM1176 and serve it to local clients (GUI, scan scripts, monitors)
+See pyTHM1176.api.thm_server for the protocol and ProbeClient for the client side.
+
+    python probe_server.py              # localhost TCP, port 5025
+    python probe_server.py /tmp/thm1176 # Unix socket
+"""
+
+import sys
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+
+import usbtmc as backend
+import pyTHM1176.api.thm_usbtmc_api as thm_api
+from pyTHM1176.api.thm_server import ProbeServer, default_address
+
+params = {"trigger_type": "single", 'range': '0.1T', 'average': 10, 'format': 'ASCII'}
+
+
+if __name__ == "__main__":
+
+    address = sys.argv[1] if len(sys.argv) > 1 else default_address
+
+    thm = thm_api.Thm1176(backend.list_devices()[0], **params)
+    server = ProbeServer(thm, address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        thm.close()
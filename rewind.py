@@ -21,14 +21,10 @@
     Date: 5 May 2021
 
 '''
-import serial
-import time
+from grbl_streamer import GrblStreamer
 # Open grbl serial port
-# s = serial.Serial('/dev/ttyACM0',115200)
-s = serial.Serial('COM8',115200)
-s.write(b"\r\n\r\n")
-time.sleep(2)   # Wait for grbl to initialize
-s.flushInput()  # Flush startup text in serial input
+# grbl = GrblStreamer('/dev/ttyACM0')
+grbl = GrblStreamer('COM8')  # wakes up grbl, lines are then streamed
 z_forwords = 'G91 Z0.1596 F100000' #1.3888 steps/mm.#'G91 Z-1.3888 F100000'  # AWAY FROM MOTOR
 z_backwords = 'G91 Z-0.1596 F100000' #'G91 Z1.3888 F100000'  # TOWARDS MOTOR
 
@@ -41,8 +37,8 @@ y_backwords = 'G91 Y-0.6415 F100000' #'G91 Y0.164 F100000'  # TOWARDS MOTOR
 
 n_rewind = 80
 for i in range(0, int(n_rewind)):
-    s.write(x_backwords.encode('utf-8') + '\n'.encode('utf-8'))
-    grbl_out = s.readline()
+    grbl.send(x_backwords)
 
-s.close()
+grbl.flush()
+grbl.close()
 print("Finished")
\ No newline at end of file
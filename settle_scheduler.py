@@ -0,0 +1,182 @@
+'''
+Settling time of the stage after each move
+
+A move excites vibrations of the stage and probe arm, which decay once the machine stops. The residual amplitude is
+modelled as proportional to the peak speed of the move, decaying exponentially:
+
+    amplitude(t) = gain * peak_speed * exp(-t / tau)
+
+the peak speed following from the distance, the acceleration and the speed limit of GRBL (trapezoidal profile). The
+settling time of a move is the time for the amplitude to fall below the tolerance, counted from the end of the motion
+(see GrblStreamer.wait_idle). gain and tau are fitted on the field recorded by the probe after a few moves
+(calibrate), amplitudes and tolerance then being field deviations, in T.
+Short moves thus only wait as long as they need to, instead of a fixed delay. Where the model is not trusted,
+wait_stable confirms stability with the probe itself, measuring until successive readings agree.
+
+    motion = StageMotion(grbl, scale=(0.6402, 0.6415, 0.1596))
+    settle = SettleScheduler(acceleration=10.0, max_speed=8.3)
+    settle.calibrate(motion, thm, [(1, 0, 0), (-1, 0, 0), (10, 0, 0), (-10, 0, 0)], **params)
+    df = PathGenerator.generate_cube_path(20, 5, settle=settle)
+
+measure_table.py calibrates the scheduler at start when settle_calibration is set.
+'''
+
+import time
+import numpy as np
+
+
+class SettleScheduler:
+
+    def __init__(self, acceleration=10.0, max_speed=8.3, gain=None, tau=None, tolerance=1e-7, min_delay=0.0,
+                 max_delay=5.0):
+        '''
+        The decay depends on the stage and probe mount: it is fitted by calibrate (or fit), or given as gain and tau
+        from an earlier calibration. Nothing is scheduled before.
+        :param acceleration: acceleration of the stage ($120...), in path unit/s2
+        :param max_speed: speed limit of the stage (max rate $110...), in path unit/s
+        :param gain: residual vibration amplitude per unit of peak speed, in T/(path unit/s), None until calibrated
+        :param tau: decay time constant of the vibrations, in s, None until calibrated
+        :param tolerance: amplitude considered settled, in T
+        :param min_delay: bounds of the settling time of a move, in s
+        :param max_delay:
+        '''
+        self.acceleration = acceleration
+        self.max_speed = max_speed
+        self.gain = gain
+        self.tau = tau
+        self.tolerance = tolerance
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def peak_speed(self, distance):
+        '''
+        :param distance: length of the move(s), in path unit
+        :return: peak speed of the trapezoidal profile, in path unit/s
+        '''
+        return np.minimum(self.max_speed, np.sqrt(np.abs(distance) * self.acceleration))
+
+    def settle_time(self, distance):
+        '''
+        :param distance: length of the move(s), in path unit
+        :return: wait after the end of the motion, in s, 0 without motion
+        '''
+        if self.gain is None or self.tau is None:
+            raise ValueError('Settle scheduler not calibrated: run calibrate, or give gain and tau')
+        distance = np.abs(np.asarray(distance, dtype=float))
+        amplitude = self.gain * self.peak_speed(distance)
+        with np.errstate(divide='ignore'):
+            delay = self.tau * np.log(amplitude / self.tolerance)
+        delay = np.clip(delay, self.min_delay, self.max_delay)
+        return np.where(distance > 0, delay, 0.0)
+
+    def delays(self, dx, dy, dz):
+        '''
+        :param dx: moves of the path along each axis, in path unit
+        :param dy:
+        :param dz:
+        :return: array of the settling time after each move, in s
+        '''
+        distance = np.sqrt(np.asarray(dx, dtype=float) ** 2 + np.asarray(dy, dtype=float) ** 2 +
+                           np.asarray(dz, dtype=float) ** 2)
+        return self.settle_time(distance)
+
+    def fit(self, peak_speeds, times, deviations):
+        '''
+        Fit gain and tau on field deviations recorded after moves, by least squares on their logarithm
+        :param peak_speeds: peak speed of the move of each sample, in path unit/s
+        :param times: time of each sample after the end of its move, in s
+        :param deviations: deviation of each sample from the settled field, in T
+        :return: (gain, tau)
+        '''
+        peak_speeds, times, deviations = (np.ravel(np.asarray(values, dtype=float))
+                                          for values in (peak_speeds, times, deviations))
+        keep = (deviations > 0) & (peak_speeds > 0)
+        if np.count_nonzero(keep) < 2:
+            raise ValueError('Not enough deviations above the noise to fit the decay')
+
+        # log(deviation / peak_speed) = log(gain) - t / tau
+        slope, intercept = np.polyfit(times[keep], np.log(deviations[keep] / peak_speeds[keep]), 1)
+        if slope >= 0:
+            raise ValueError('Deviations do not decay')
+        self.gain = np.exp(intercept)
+        self.tau = -1.0 / slope
+        return self.gain, self.tau
+
+    def calibrate(self, motion, thm, moves, duration=3.0, period=0.01, **kwargs):
+        '''
+        Record the field after each move and fit the decay on it
+        :param motion: StageMotion, scaling the moves to machine units
+        :param thm: Thm1176 instance
+        :param moves: list of relative moves (dx, dy, dz) in path unit, e.g. of increasing length back and forth
+        :param duration: recording after each move, in s
+        :param period: sampling period of the recording, in s
+        :param kwargs: setup parameters of the probe, the averaging of each sample fitting in the period
+        :return: (gain, tau)
+        '''
+        peak_speeds, times, deviations = [], [], []
+        for delta in moves:
+            sample_times, sample_deviations = record_decay(motion, thm, delta, duration, period, **kwargs)
+            peak_speeds.append(np.full(len(sample_times), self.peak_speed(np.linalg.norm(delta))))
+            times.append(sample_times)
+            deviations.append(sample_deviations)
+        return self.fit(np.concatenate(peak_speeds), np.concatenate(times), np.concatenate(deviations))
+
+
+def record_decay(motion, thm, delta, duration=3.0, period=0.01, **kwargs):
+    '''
+    Move, then record the field until it settles
+    :param motion: StageMotion
+    :param thm: Thm1176 instance
+    :param delta: relative move (dx, dy, dz), in path unit
+    :param duration: recording, in s
+    :param period: sampling period, in s
+    :param kwargs: setup parameters of the probe
+    :return: (times of the samples after the end of the motion in s, their deviation from the settled field in T,
+    0 where within the noise)
+    '''
+    motion.move_by(delta)
+    status = motion.wait_idle()
+    start = time.monotonic()
+    n_samples = min(int(duration / period), thm.max_block_size)
+    stats = thm.make_block_measurement(n_samples, period, **kwargs)
+
+    host_times = np.array(thm.last_reading['HostTime'], dtype=float)
+    if np.all(np.isfinite(host_times)):
+        times = host_times - status['time']
+    else:
+        times = start - status['time'] + period * np.arange(n_samples)
+
+    # the last quarter of the recording is taken as settled
+    settled = slice(3 * n_samples // 4, None)
+    deviation = np.zeros(n_samples)
+    noise = 0.0
+    for key in thm.field_axes:
+        samples = stats[key]['samples']
+        deviation += (samples - samples[settled].mean()) ** 2
+        noise += samples[settled].var()
+    deviation = np.sqrt(deviation)
+    deviation[deviation < 3 * np.sqrt(noise)] = 0.0
+    return times, deviation
+
+
+def wait_stable(thm, tolerance, timeout=5.0, interval=0.1, **kwargs):
+    '''
+    Measure until two successive readings agree within tolerance on every field axis
+    :param thm: Thm1176 instance
+    :param tolerance: in T
+    :param timeout: in s, longest wait
+    :param interval: in s, least time between the readings compared, so that a slow drift is not taken as stable
+    :param kwargs: setup parameters of the probe, with a short averaging
+    :return: True if stable, False on timeout (the last reading being left in thm.last_reading either way)
+    '''
+    start = time.monotonic()
+    thm.make_measurement(**kwargs)
+    previous = [np.mean(thm.last_reading[key]) for key in thm.field_axes]
+    while time.monotonic() - start < timeout:
+        time.sleep(interval)
+        thm.make_measurement(**kwargs)
+        current = [np.mean(thm.last_reading[key]) for key in thm.field_axes]
+        if np.all(np.abs(np.subtract(current, previous)) <= tolerance):
+            return True
+        previous = current
+    return False
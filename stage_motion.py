@@ -0,0 +1,87 @@
+'''
+Absolute motion of the stage, in the coordinates of the path tables
+
+Moving by relative (G91) steps taken from the differences between successive rows accumulates rounding, and ties each
+move to the previous row: a path cannot be reordered, resumed or split without recomputing the chain. StageMotion
+moves to the absolute position of each row instead (G90, in the G54 work coordinates), tracking the commanded
+position. The work origin is set once at the center of the table (zero_here), and is kept by GRBL across resets, so
+that a scan can be resumed at any row after an interruption. zero_here overwrites the stored origin: it is an explicit
+step before the first run of a table (zero_at_start of measure_table.py, "Zero Stage Here" of the GUI), never taken
+when resuming.
+Positions are in path units (mm of the tables), converted to machine units by scale, as direction_step_sizes of
+measure_table.py.
+
+    motion = StageMotion(grbl, scale=(0.6402, 0.6415, 0.1596))
+    motion.zero_here()  # once, the stage being at the center
+    motion.move_to((x, y, z))
+    status = motion.wait_idle()
+'''
+
+import numpy as np
+
+
+class StageMotion:
+    position_tolerance = 0.01  # path units, difference between commanded and reported position reported as drift
+
+    def __init__(self, grbl, scale=(1.0, 1.0, 1.0), feed=100000):
+        '''
+
+        :param grbl: GrblStreamer
+        :param scale: machine units per path unit, for each axis
+        :param feed: feed of the moves, in machine units/min (limited by the max rates of GRBL)
+        '''
+        self.grbl = grbl
+        self.scale = np.asarray(scale, dtype=float)
+        self.feed = feed
+        self.position = None  # commanded position, in path units, None until known
+
+    def zero_here(self):
+        '''
+        Make the current position the work origin (G10 L20 P1 sets the G54 offset, kept by GRBL across resets)
+        '''
+        self.grbl.send("G10 L20 P1 X0 Y0 Z0")
+        self.position = np.zeros(3)
+
+    def move_command(self, point, feed=None):
+        if feed is None:
+            feed = self.feed
+        return "G90 G1 X{:.4f} Y{:.4f} Z{:.4f} F{:.3f}".format(*(np.asarray(point, dtype=float) * self.scale), feed)
+
+    def move_to(self, point, feed=None):
+        '''
+        Stream a move to an absolute position, nothing being sent if the stage is already there
+        :param point: (x, y, z), in path units
+        :param feed: feed of this move, in machine units/min, feed of the instance if None
+        :return: the GrblCommand of the move, None if no move was sent
+        '''
+        point = np.asarray(point, dtype=float)
+        if self.position is not None and np.allclose(point, self.position):
+            return None
+        cmd = self.grbl.send(self.move_command(point, feed))
+        self.position = point
+        return cmd
+
+    def move_by(self, delta):
+        '''
+        Stream a move relative to the current position (G91), e.g. for moves independent of the work origin
+        :param delta: (dx, dy, dz), in path units
+        :return: the GrblCommand of the move
+        '''
+        delta = np.asarray(delta, dtype=float)
+        cmd = self.grbl.send("G91 G1 X{:.4f} Y{:.4f} Z{:.4f} F{:.3f}".format(*(delta * self.scale), self.feed))
+        if self.position is not None:
+            self.position = self.position + delta
+        return cmd
+
+    def wait_idle(self, timeout=None):
+        '''
+        Wait for the end of the motion, see GrblStreamer.wait_idle, and check the position reached
+        :return: the Idle status, with the reached 'WPos' in path units added as 'position' when reported
+        '''
+        status = self.grbl.wait_idle(timeout)
+        if 'WPos' in status:
+            status['position'] = status['WPos'][:3] / self.scale
+            if self.position is not None and np.any(np.abs(status['position'] - self.position) >
+                                                     self.position_tolerance):
+                print("Stage at", status['position'], "instead of", self.position)
+        return status